@@ -13,10 +13,12 @@ from re import findall
 import cv2
 import numpy as np
 
-from visAnnotDiff import dashrect
+from videoIndex import VideoSeeker
+from visAnnotDiff import Overlay, hex2bgr
 
 
-def visualize_bbox(image: np.ndarray, tool, bold=False, dashed=False, thickness: int = 2) -> np.ndarray:
+def visualize_bbox(image: np.ndarray, tool, bold=False, dashed=False, thickness: int = 2,
+                   overlay: Overlay = None) -> np.ndarray:
     """
     Draws a bounding box on an image
 
@@ -24,29 +26,25 @@ def visualize_bbox(image: np.ndarray, tool, bold=False, dashed=False, thickness:
         image (np.ndarray): image to draw a bounding box onto
         tool (Dict[str,any]): Dict response from the export
         bold (str): False if rectangle should be without bold boundaries
+        overlay (Overlay): the bbox and its label are added to the overlay drawn later instead of the image
     Returns:
         image with a bounding box drawn on it.
     """
     start = (int(tool['bbox']["left"]), int(tool['bbox']["top"]))
     end = (int(tool['bbox']["left"] + tool['bbox']["width"]),
            int(tool['bbox']["top"] + tool['bbox']["height"]))
-    h = tool['color'].lstrip('#')
-    color = tuple(int(h[i:i + 2], 16) for i in (4, 2, 0))  # BGR
+    color = hex2bgr(tool['color'])
 
     k = 1 if not bold else 2
-    if not dashed:
-        cv2.rectangle(image, start, end, color, thickness * k)
-    else:
-        dashrect(image, start, end, color, thickness * k, 'dashed')
+    drawn = overlay if overlay is not None else Overlay()
+    drawn.rect(start, end, color, thickness * k, 'dashed' if dashed else '')
 
     if tool['id'][:2] != "ah" and tool['id'][0] == "a":
-        cv2.putText(image, tool['id'], (start[0], end[1]),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.8, color, 1 * k)
+        drawn.text(tool['id'], (start[0], end[1]), color, 0.8, 1 * k)
     else:
-        cv2.putText(image, tool['id'], (start[0], start[1] - 3),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.8, color, 1 * k)
+        drawn.text(tool['id'], (start[0], start[1] - 3), color, 0.8, 1 * k)
 
-    return image
+    return image if overlay is not None else drawn.draw(image)
 
 
 class App:
@@ -58,7 +56,7 @@ class App:
         self.horizontal = horizontal
         self.w0 = w0
         self.vidpath = video
-        self.vid = cv2.VideoCapture(video)
+        self.vid = VideoSeeker(video)
         # left (first frame) and right frame (next frame) respectively
         _, self.fframe = self.vid.read()
         _, self.nframe = self.vid.read()
@@ -91,7 +89,7 @@ class App:
 
         self.drawRoi()
         cv2.createTrackbar(self.trTitle, self.windowName, 0,
-                           int(self.vid.get(cv2.CAP_PROP_FRAME_COUNT)) - 2,
+                           self.vid.count - 2,
                            # -2 because we start from 0, and we show 2 frames at one time
                            self.trackbar)
         cv2.setMouseCallback(self.windowName, self.react)
@@ -110,7 +108,7 @@ class App:
                     json.dump(self.file, f)
                 cv2.destroyAllWindows()
                 break
-            elif key == ord('n') and self.trackerPos < int(self.vid.get(cv2.CAP_PROP_FRAME_COUNT)) - 3:
+            elif key == ord('n') and self.trackerPos < self.vid.count - 3:
                 self.trackbar(self.trackerPos + 1)
             elif key == ord('p') and self.trackerPos > 0:
                 self.trackbar(self.trackerPos - 1)
@@ -153,7 +151,7 @@ class App:
                 try:
                     newId = int(newId)
                     newId = letter + str(newId)
-                    for j in range(self.trackerPos + 1, int(self.vid.get(cv2.CAP_PROP_FRAME_COUNT))):
+                    for j in range(self.trackerPos + 1, self.vid.count):
                         changed = {'old': -1,
                                    'new': -1}
                         for i, obj in enumerate(self.file[self.trackerPos + 1]['objects']):
@@ -187,6 +185,7 @@ class App:
             cv2.putText(img[i], str(self.trackerPos + i), (0, 35),
                         cv2.FONT_HERSHEY_SIMPLEX, 1.2, (255, 0, 0), 4)
 
+            overlay = Overlay()
             for obj in self.file[self.trackerPos + i]['objects']:
                 bold = True if obj['id'] in ids else False
                 dashed = False
@@ -195,27 +194,31 @@ class App:
                         dashed = True if obj['id'] in self.notClear[str(self.trackerPos + 2)] else False
                     except KeyError:
                         pass
-                img[i] = visualize_bbox(img[i], obj, thickness=rt, bold=bold, dashed=dashed)
+                visualize_bbox(img[i], obj, thickness=rt, bold=bold, dashed=dashed, overlay=overlay)
+            overlay.draw(img[i])
 
         if self.horizontal:
             img = np.hstack(img)
         else:
             img = np.vstack(img)
         if self.mode in ('2', '1'):
+            overlay = Overlay()
             for p_obj in self.file[self.trackerPos]['objects']:
                 for n_obj in self.file[self.trackerPos + 1]['objects']:
                     if p_obj['id'] == n_obj['id']:
                         bold = True if p_obj['id'] in ids else False
                         if self.mode == '2' and bold:
                             img = self.visualize_line(img, p_obj, n_obj, thickness=rt, bold=bold)
-                            cv2.imshow(self.windowName, img)
+                            cv2.imshow(self.windowName, overlay.draw(img))
                             return 0
                         elif self.mode == '1':
-                            img = self.visualize_line(img, p_obj, n_obj, thickness=rt, bold=bold)
+                            self.visualize_line(img, p_obj, n_obj, thickness=rt, bold=bold, overlay=overlay)
+            overlay.draw(img)
 
         cv2.imshow(self.windowName, img)
 
-    def visualize_line(self, image: np.ndarray, p_obj, n_obj, bold=False, thickness: int = 2) -> np.ndarray:
+    def visualize_line(self, image: np.ndarray, p_obj, n_obj, bold=False, thickness: int = 2,
+                       overlay: Overlay = None) -> np.ndarray:
         """
         Draws a bounding box on an image
 
@@ -223,6 +226,7 @@ class App:
             image (np.ndarray): image to draw a bounding box onto
             tool (Dict[str,any]): Dict response from the export
             bold (str): False if rectangle should be without bold boundaries
+            overlay (Overlay): the line is added to the overlay drawn later instead of the image
         Returns:
             image with a bounding box drawn on it.
         """
@@ -236,11 +240,13 @@ class App:
             end = (int(n_obj['bbox']["left"] + n_obj['bbox']["width"] / 2),
                    int(n_obj['bbox']["top"] + n_obj['bbox']["height"] / 2 + self.h))
 
-        h = p_obj['color'].lstrip('#')
-        color = tuple(int(h[i:i + 2], 16) for i in (4, 2, 0))  # BGR
+        color = hex2bgr(p_obj['color'])
 
         k = 1 if not bold else 2
-        cv2.line(image, start, end, color=color, thickness=thickness * k)
+        if overlay is not None:
+            overlay.line(start, end, color, thickness * k)
+        else:
+            cv2.line(image, start, end, color=color, thickness=thickness * k)
 
         return image
 
@@ -250,8 +256,7 @@ class App:
         val (str): new trackbar position
         """
         self.trackerPos = val
-        self.vid.set(cv2.CAP_PROP_POS_FRAMES, int(val))
-        _, self.fframe = self.vid.read()
+        _, self.fframe = self.vid.read(int(val))
         _, self.nframe = self.vid.read()
         self.drawRoi()
 
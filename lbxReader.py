@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+:Description: Incremental reader of the Labelbox video export, which parses one frame at a time
+instead of loading the whole file.
+
+:Authors: (c) Valentyna Pryhodiuk <vpryhodiuk@lumais.com>
+:Date: 2026-10-17
+"""
+import json
+from typing import Dict, Iterator
+
+# size of the text block read from the export at once
+CHUNK_SIZE = 1 << 20
+
+
+def iter_frames(filepath: str, chunk_size: int = CHUNK_SIZE) -> Iterator[Dict]:
+    """
+    Yields the frames {"frameNumber": <int>, "objects": [...], ...} of the top-level array
+    of the Labelbox export one by one. Only the current frame and a text block are kept in memory,
+    so the iteration can be stopped after the last required frame without parsing the rest of the file.
+
+    Args:
+        filepath (str): path to the json file
+        chunk_size (int): size of the text block read at once
+    Returns:
+        iterator over the frames
+    """
+    decoder = json.JSONDecoder()
+    with open(filepath, 'r') as file:
+        buf = file.read(chunk_size)
+        pos = _skip(buf, 0)
+        if buf[pos:pos + 1] != '[':
+            raise ValueError('{} is not a Labelbox export: the top-level array is expected'.format(filepath))
+        pos += 1
+        eof = False
+        while True:
+            pos = _skip(buf, pos, ',')
+            if pos == len(buf):
+                if eof:
+                    raise ValueError('{} is truncated: the top-level array is not closed'.format(filepath))
+                buf, pos = buf[pos:] + file.read(chunk_size), 0
+                eof = pos == len(buf)
+                continue
+            if buf[pos] == ']':
+                return
+            try:
+                frame, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # the frame is split by the block boundary, read the block of at least the same size
+                block = file.read(max(chunk_size, len(buf) - pos))
+                eof = not block
+                buf, pos = buf[pos:] + block, 0
+                continue
+            yield frame
+            pos = end
+            if pos >= chunk_size:
+                buf, pos = buf[pos:], 0
+
+
+def _skip(buf: str, pos: int, chars: str = '') -> int:
+    """
+    Returns the position of the first character after pos which is neither whitespace nor one of chars.
+    """
+    while pos < len(buf) and (buf[pos].isspace() or buf[pos] in chars):
+        pos += 1
+    return pos
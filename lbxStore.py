@@ -0,0 +1,553 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+:Description: Columnar store of the Labelbox video export. The export is converted once into a directory
+of NumPy arrays (struct of arrays with the per-frame offsets), which is memory-mapped on loading
+to get any frame without parsing the JSON.
+
+:Authors: (c) Valentyna Pryhodiuk <vpryhodiuk@lumais.com>
+:Date: 2026-10-17
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from array import array
+from contextlib import contextmanager
+from typing import Dict, Iterable
+
+try:
+    import fcntl
+except ImportError:  # the entries are not locked on Windows
+    fcntl = None
+
+import numpy as np
+
+from lbxReader import iter_frames
+
+STORE_VERSION = 2
+# names of the tables of the interned strings in meta.json
+TABLES = ('classes', 'features', 'schemas', 'colors', 'attributes')
+# name, dtype of the arrays of the store
+COLUMNS = (('frames', np.int32),  # frameNumber of each frame
+           ('offsets', np.int64),  # objects of the frame i are offsets[i]:offsets[i + 1]
+           ('cls', np.int16),  # index of the object title in classes
+           ('bbox', np.float32),  # (left, top, width, height) of each object
+           ('feature', np.int32),  # index of the featureId in features
+           ('schema', np.int16),  # index of the schemaId in schemas
+           ('color', np.int16),  # index of the color in colors
+           ('keyframe', np.bool_),
+           ('attrs', np.uint64),  # bitmask of the attribute values, bit i stands for attributes[i]
+           ('attr_keyframes', np.uint64))  # bitmask of the attribute values set on this frame
+# columns of the source json of the frames, the frame i is raw[raw_offsets[i]:raw_offsets[i + 1]] (since version 2)
+RAW_COLUMNS = (('raw', np.uint8),
+               ('raw_offsets', np.int64))
+
+# directory and size limit in bytes of the cache of the parsed exports
+CACHE_DIR = os.environ.get('LBX_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'lbxstore'))
+CACHE_SIZE = int(os.environ.get('LBX_CACHE_SIZE', 4 << 30))
+# age in seconds after which the replaced entries and the abandoned builds are removed from the cache
+STALE_AGE = 3600
+# number of the reads of the entry stamp before it is considered invalid, and the delay between them in seconds
+STAMP_ATTEMPTS, STAMP_DELAY = 3, 0.05
+
+
+class Interner(dict):
+    """
+    Maps the strings to their consecutive indices.
+    """
+
+    def __call__(self, value) -> int:
+        ind = self.get(value)
+        if ind is None:
+            ind = self[value] = len(self)
+        return ind
+
+    def table(self) -> list:
+        return list(self.keys())
+
+
+def build_columns(frames: Iterable[Dict], exact: bool = False, raw: bool = False) -> tuple:
+    """
+    Converts the frames of the Labelbox export into the columns of the store in one pass.
+
+    Args:
+        frames (iterable): list from loaded json file or iterator over its frames (see lbxReader.iter_frames)
+        exact (bool): True if the bboxes should be kept as float64 instead of float32
+        raw (bool): True if the source json of the frames should be kept to return them unchanged
+    Returns:
+        meta (dict), columns {name: np.ndarray}
+    """
+    tables = {name: Interner() for name in TABLES}
+    cols = {'frames': array('i'), 'offsets': array('q', [0]), 'cls': array('h'), 'bbox': array('d'),
+            'feature': array('i'), 'schema': array('h'), 'color': array('h'), 'keyframe': array('b'),
+            'attrs': array('Q'), 'attr_keyframes': array('Q')}
+    source, source_offsets = bytearray(), array('q', [0])
+    attributes = tables['attributes']
+
+    for frame in frames:
+        cols['frames'].append(frame['frameNumber'])
+        if raw:
+            source += json.dumps(frame, separators=(',', ':')).encode()
+            source_offsets.append(len(source))
+        for obj in frame['objects']:
+            b = obj['bbox']
+            cols['cls'].append(tables['classes'](obj['title']))
+            cols['bbox'].extend((b['left'], b['top'], b['width'], b['height']))
+            cols['feature'].append(tables['features'](obj.get('featureId')))
+            cols['schema'].append(tables['schemas'](obj.get('schemaId')))
+            cols['color'].append(tables['colors'](obj.get('color')))
+            cols['keyframe'].append(bool(obj.get('keyframe')))
+            mask, kmask = 0, 0
+            for classif in obj.get('classifications') or []:
+                for answer in classif.get('answers') or []:
+                    bit = 1 << attributes(answer['value'])
+                    mask |= bit
+                    if answer.get('keyframe'):
+                        kmask |= bit
+            cols['attrs'].append(mask)
+            cols['attr_keyframes'].append(kmask)
+        cols['offsets'].append(len(cols['cls']))
+
+    if len(attributes) > 64:
+        raise ValueError('The store supports up to 64 attributes, {} are found'.format(len(attributes)))
+    meta = {'version': STORE_VERSION}
+    meta.update({name: table.table() for name, table in tables.items()})
+    columns = {name: np.frombuffer(cols[name], dtype=cols[name].typecode).astype(dtype) for name, dtype in COLUMNS}
+    columns['bbox'] = columns['bbox'].reshape(-1, 4)
+    if exact:
+        columns['bbox'] = np.frombuffer(cols['bbox'], dtype=np.float64).reshape(-1, 4)
+    if raw:
+        columns['raw'] = np.frombuffer(source, dtype=np.uint8)
+        columns['raw_offsets'] = np.frombuffer(source_offsets, dtype=np.int64)
+    return meta, columns
+
+
+def save_store(frames: Iterable[Dict], dirpath: str, exact: bool = False) -> str:
+    """
+    Converts the Labelbox export into the columnar store. The source json of the frames is kept
+    along the columns, so the store gives back the frames of the export unchanged.
+
+    Args:
+        frames (iterable): list from loaded json file or iterator over its frames
+        dirpath (str): output directory of the store
+        exact (bool): True if the bboxes should be kept as float64 instead of float32
+    Returns:
+        dirpath
+    """
+    meta, columns = build_columns(frames, exact, raw=True)
+    os.makedirs(dirpath, exist_ok=True)
+    for name, col in columns.items():
+        np.save(os.path.join(dirpath, name + '.npy'), col)
+    # meta.json is written the last to mark the store as complete
+    with open(os.path.join(dirpath, 'meta.json'), 'w') as file:
+        json.dump(meta, file)
+    return dirpath
+
+
+def is_store(path: str) -> bool:
+    return os.path.isdir(path) and os.path.isfile(os.path.join(path, 'meta.json'))
+
+
+class LbxStore:
+    """
+    Read access to the columnar store, which behaves like the list of frames of the Labelbox export.
+
+    Frames are decoded as dicts on access, equal to the frames of the export. Frames taken by index are kept,
+    so their changes are preserved and seen by the iteration, e.g. to dump the edited annotations
+    with json.dump(list(store)). The stores of version 1 keep no source json, their frames are reconstructed
+    from the columns: the "value" of the objects is equal to their "title", the bboxes are floats, and "id",
+    "relationships" and the fields of the classifications besides the answer values are lost.
+
+    Fields:
+        classes, features, schemas, colors, attributes (list) - tables of the interned strings
+        frames, offsets, cls, bbox, feature, schema, color, keyframe, attrs, attr_keyframes (np.ndarray) - columns
+        raw, raw_offsets (np.ndarray) - source json of the frames, None if the store does not keep it
+        path (str) - directory of the opened store, None if the store is built in memory
+    """
+
+    def __init__(self, meta: Dict, columns: Dict[str, np.ndarray], source: list = None):
+        if meta.get('version') not in (1, STORE_VERSION):
+            raise ValueError('Unsupported version of the annotation store: {}'.format(meta.get('version')))
+        for name in TABLES:
+            setattr(self, name, meta[name])
+        for name, _ in COLUMNS + RAW_COLUMNS:
+            setattr(self, name, columns.get(name))
+        self._source = source
+        self._edited = {}
+        self.path = None
+
+    @classmethod
+    def open(cls, dirpath: str, mmap: bool = True) -> 'LbxStore':
+        """
+        Args:
+            dirpath (str): directory of the store
+            mmap (bool): True if the columns should be memory-mapped instead of being read
+        """
+        with open(os.path.join(dirpath, 'meta.json')) as file:
+            meta = json.load(file)
+        columns = {name: np.load(os.path.join(dirpath, name + '.npy'), mmap_mode='r' if mmap else None)
+                   for name, _ in COLUMNS}
+        if meta.get('version') != 1:
+            columns.update({name: np.load(os.path.join(dirpath, name + '.npy'), mmap_mode='r' if mmap else None)
+                            for name, _ in RAW_COLUMNS})
+        store = cls(meta, columns)
+        store.path = dirpath
+        return store
+
+    @classmethod
+    def from_frames(cls, frames: Iterable[Dict]) -> 'LbxStore':
+        """
+        Builds the columnar view of the export in memory, the frames are returned as they are given.
+        """
+        frames = list(frames)
+        return cls(*build_columns(frames), source=frames)
+
+    def exact(self) -> bool:
+        """
+        Returns:
+            True if the frames are returned unchanged, False if they are reconstructed from the columns
+        """
+        return self._source is not None or self.raw is not None
+
+    def nbytes(self) -> int:
+        return sum(getattr(self, name).nbytes for name, _ in COLUMNS + RAW_COLUMNS if getattr(self, name) is not None)
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def span(self, i: int) -> tuple:
+        """
+        Returns:
+            (first, last + 1) indices of the objects of the frame i
+        """
+        return int(self.offsets[i]), int(self.offsets[i + 1])
+
+    def frame(self, i: int) -> Dict:
+        """
+        Decodes the frame i in the format of the Labelbox export.
+        """
+        if self._source is not None:
+            return self._source[i]
+        if self.raw is not None:
+            return json.loads(self.raw[self.raw_offsets[i]:self.raw_offsets[i + 1]].tobytes())
+        first, last = self.span(i)
+        bboxes = self.bbox[first:last].tolist()
+        cls, feature = self.cls[first:last].tolist(), self.feature[first:last].tolist()
+        schema, color = self.schema[first:last].tolist(), self.color[first:last].tolist()
+        keyframe = self.keyframe[first:last].tolist()
+        attrs, kattrs = self.attrs[first:last].tolist(), self.attr_keyframes[first:last].tolist()
+
+        objects = []
+        for j, (left, top, width, height) in enumerate(bboxes):
+            answers = [{'value': name, 'keyframe': bool(kattrs[j] >> bit & 1)}
+                       for bit, name in enumerate(self.attributes) if attrs[j] >> bit & 1]
+            obj = {'featureId': self.features[feature[j]],
+                   'schemaId': self.schemas[schema[j]],
+                   'title': self.classes[cls[j]],
+                   'value': self.classes[cls[j]],
+                   'color': self.colors[color[j]],
+                   'keyframe': keyframe[j],
+                   'bbox': {'top': top, 'left': left, 'height': height, 'width': width},
+                   'classifications': [{'answers': answers}] if answers else []}
+            if obj['color'] is None:
+                del obj['color']
+            objects.append(obj)
+        return {'frameNumber': int(self.frames[i]), 'objects': objects, 'classifications': []}
+
+    def __getitem__(self, i: int) -> Dict:
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('frame index out of range')
+        if i not in self._edited:
+            self._edited[i] = self.frame(i)
+        return self._edited[i]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._edited[i] if i in self._edited else self.frame(i)
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _cache_entry(path: str, cachedir: str) -> str:
+    return os.path.join(cachedir, hashlib.sha1(os.path.abspath(path).encode()).hexdigest())
+
+
+def _dir_size(dirpath: str) -> int:
+    return sum(entry.stat().st_size for entry in os.scandir(dirpath) if entry.is_file())
+
+
+@contextmanager
+def _locked(entry: str, shared: bool = False, blocking: bool = True):
+    """
+    Holds the lock of the cache entry: shared to open the entry, exclusive to replace or evict it.
+    Yields False if the lock is not acquired without blocking. The lock file is removed with the entry
+    under the exclusive lock (see _remove_lock), so the lock is taken again if its file is removed meanwhile.
+    """
+    if fcntl is None:
+        yield True
+        return
+    lockpath = entry + '.lock'
+    while True:
+        file = open(lockpath, 'a')
+        try:
+            fcntl.flock(file, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB))
+            if os.path.exists(lockpath) and os.path.samestat(os.fstat(file.fileno()), os.stat(lockpath)):
+                break
+        except BlockingIOError:
+            file.close()
+            yield False
+            return
+        except FileNotFoundError:
+            pass
+        file.close()
+    with file:
+        yield True  # the lock is released on closing the file
+
+
+def _remove_lock(entry: str):
+    # called under the exclusive lock of the entry
+    if fcntl is not None:
+        try:
+            os.remove(entry + '.lock')
+        except FileNotFoundError:
+            pass
+
+
+def _read_stamp(stamp: str):
+    # the stamp is replaced atomically, the failed read is retried in case the file is being replaced
+    for attempt in range(STAMP_ATTEMPTS):
+        try:
+            with open(stamp) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            time.sleep(STAMP_DELAY)
+    return None
+
+
+def _write_stamp(stamp: str, source: Dict):
+    part = '{}.{}.part'.format(stamp, os.getpid())
+    with open(part, 'w') as file:
+        json.dump(source, file)
+    os.replace(part, stamp)
+
+
+def _discard(entry: str):
+    """
+    Moves the entry aside, the processes which have mapped its files keep reading them.
+    The entry is removed after STALE_AGE (see _reap).
+    """
+    aside = os.path.join(os.path.dirname(entry),
+                         '.stale-{}-{}'.format(os.path.basename(entry), os.urandom(4).hex()))
+    try:
+        os.rename(entry, aside)
+        os.utime(aside)
+    except FileNotFoundError:
+        pass
+
+
+def _reap(cachedir: str):
+    """
+    Removes the entries moved aside and the abandoned builds older than STALE_AGE,
+    and the lock files left without their entries.
+    """
+    for entry in os.scandir(cachedir):
+        try:
+            if entry.name.startswith(('.stale-', '.tmp-')) and entry.is_dir() and \
+                    time.time() - entry.stat().st_mtime > STALE_AGE:
+                shutil.rmtree(entry.path, ignore_errors=True)
+            elif entry.name.endswith('.lock') and not os.path.isdir(entry.path[:-5]):
+                # the entries being built are locked and skipped
+                with _locked(entry.path[:-5], blocking=False) as locked:
+                    if locked and not os.path.isdir(entry.path[:-5]):
+                        _remove_lock(entry.path[:-5])
+        except OSError:
+            pass
+
+
+def _open_entry(path: str, entry: str):
+    source = _read_stamp(os.path.join(entry, 'source.json'))
+    if source is None:
+        return None
+    try:
+        stat = os.stat(path)
+        if (source['size'], source['mtime_ns']) != (stat.st_size, stat.st_mtime_ns):
+            if source['size'] != stat.st_size or source['hash'] != file_hash(path):
+                return None
+            source['mtime_ns'] = stat.st_mtime_ns
+        # the last use orders the entries for the eviction
+        source['used'] = time.time()
+        try:
+            _write_stamp(os.path.join(entry, 'source.json'), source)
+        except OSError:
+            pass
+        store = LbxStore.open(entry)
+        # the entries of version 1 do not return the frames unchanged and are rebuilt
+        return store if store.exact() else None
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def lookup_cache(path: str, cachedir: str = None):
+    """
+    Opens the cached store of the json file if it is up to date. The entry is valid if the size and
+    mtime of the file are unchanged or, otherwise, if the content hash is the same.
+
+    Args:
+        path (str): path to the json file
+        cachedir (str): directory of the cache, CACHE_DIR by default
+    Returns:
+        LbxStore or None
+    """
+    entry = _cache_entry(path, cachedir or CACHE_DIR)
+    if not os.path.isfile(os.path.join(entry, 'source.json')):
+        return None
+    try:
+        with _locked(entry, shared=True):
+            return _open_entry(path, entry)
+    except OSError:
+        return None
+
+
+def cache_store(path: str, cachedir: str = None, limit: int = CACHE_SIZE) -> LbxStore:
+    """
+    Opens the cached store of the json file, parsing the file and caching it on a miss.
+    The entry is built by one process at a time, the others wait for it and open the built entry.
+    The outdated entry is moved aside instead of being removed, so the processes using it are not affected.
+    Least recently used entries are evicted to keep the cache within the limit.
+
+    Args:
+        path (str): path to the json file
+        cachedir (str): directory of the cache, CACHE_DIR by default
+        limit (int): maximal size of the cache in bytes
+    Returns:
+        LbxStore
+    """
+    cachedir = cachedir or CACHE_DIR
+    store = lookup_cache(path, cachedir)
+    if store is not None:
+        return store
+
+    os.makedirs(cachedir, exist_ok=True)
+    entry = _cache_entry(path, cachedir)
+    with _locked(entry):
+        # the entry could be built by another process while the lock was awaited
+        store = _open_entry(path, entry)
+        if store is None:
+            stat = os.stat(path)
+            source = {'source': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                      'hash': file_hash(path), 'used': time.time()}
+            tmpdir = tempfile.mkdtemp(prefix='.tmp-', dir=cachedir)
+            try:
+                save_store(iter_frames(path), tmpdir, exact=True)
+                _write_stamp(os.path.join(tmpdir, 'source.json'), source)
+                _discard(entry)
+                os.replace(tmpdir, entry)
+            except BaseException:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+                raise
+            store = LbxStore.open(entry)
+    _reap(cachedir)
+    evict_cache(cachedir, limit, keep=entry)
+    return store
+
+
+def evict_cache(cachedir: str = None, limit: int = CACHE_SIZE, keep: str = None):
+    """
+    Moves aside the least recently used entries until the cache fits the limit (see _discard).
+    The entries locked by other processes are skipped.
+
+    Args:
+        cachedir (str): directory of the cache, CACHE_DIR by default
+        limit (int): maximal size of the cache in bytes
+        keep (str): entry which should not be removed
+    """
+    cachedir = cachedir or CACHE_DIR
+    entries = []
+    for entry in os.scandir(cachedir):
+        if not entry.is_dir() or entry.name.startswith('.'):
+            continue
+        source = _read_stamp(os.path.join(entry.path, 'source.json')) or {}
+        try:
+            entries.append((source.get('used', 0), _dir_size(entry.path), entry.path))
+        except OSError:  # the entry is moved aside by another process
+            continue
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= limit:
+            break
+        if path == keep:
+            continue
+        with _locked(path, blocking=False) as locked:
+            if locked:
+                _discard(path)
+                _remove_lock(path)
+                total -= size
+
+
+def store_path(path: str, cache: bool = True) -> str:
+    """
+    Resolves the annotations to the store read by other processes: the json file is cached once (see cache_store),
+    so the processes open the store directly without accessing the cache.
+
+    Args:
+        path (str): directory of the store or path to the json file
+        cache (bool): False if the json file should be parsed bypassing the cache
+    Returns:
+        directory of the store, or path to the json file if it bypasses the cache
+    """
+    if is_store(path) or not cache:
+        return path
+    return cache_store(path).path
+
+
+def clear_cache(cachedir: str = None):
+    shutil.rmtree(cachedir or CACHE_DIR, ignore_errors=True)
+
+
+def load_annotations(path: str, cache: bool = True):
+    """
+    Opens the annotations either from the columnar store or from the Labelbox export.
+    The export is parsed once and then loaded from its cached store (see cache_store).
+
+    Args:
+        path (str): directory of the store or path to the json file
+        cache (bool): False if the json file should be parsed bypassing the cache
+    Returns:
+        LbxStore or list of frames
+    """
+    if is_store(path):
+        return LbxStore.open(path)
+    if cache:
+        return cache_store(path)
+    with open(path, 'r') as file:
+        return json.load(file)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Document Taxonomy Builder.',
+                            formatter_class=ArgumentDefaultsHelpFormatter,
+                            conflict_handler='resolve')
+    parser.add_argument('-json-path', '--filepath', type=str, help='Path to the json file', required=True)
+    parser.add_argument('-o', '--outp-dir', type=str,
+                        help='Output directory of the store, <FILEPATH without .json>.lbx by default')
+    args = parser.parse_args()
+
+    outdir = args.outp_dir or os.path.splitext(args.filepath)[0] + '.lbx'
+    store = LbxStore.open(save_store(iter_frames(args.filepath), outdir))
+    print('saved {} frames, {} objects as {}'.format(len(store), len(store.cls), outdir))
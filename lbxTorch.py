@@ -7,9 +7,15 @@ and converting latter annotations into YOLOv5 format.
 :Authors: (c) Valentyna Pryhodiuk <vpryhodiuk@lumais.com>
 :Date: 2020-11-04
 """
-import json
 import os
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter, SUPPRESS
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice, repeat
+from time import perf_counter
+import numpy as np
+from lbxReader import iter_frames
+from lbxStore import LbxStore, is_store, lookup_cache, cache_store, clear_cache
+from yoloShards import LabelDir, ShardWriter
 
 # Dictionary that maps class names to IDs
 class_name_to_id_mapping = {"ant": 0,
@@ -34,75 +40,199 @@ def strparse(fstr):
     return framelst
 
 
+# find the position of the last frame required by the intervals, None if the frames are required up to the end
+def last_frame(framelst):
+    endings = [ending for _, ending in framelst]
+    return None if '$' in endings else max(map(int, endings))
+
+
+# open the annotations from the store, the cache or the json file parsed lazily
+def open_annotations(filepath, fstr='1-$', cache=True):
+    """
+    Args:
+        filepath (str): path to the json file or the annotation store
+        fstr (str): string of intervals <n1>-<n2>,<n3>-<n4>,<n5>... to be processed
+        cache (bool): False if the json file should be parsed bypassing the cache of the parsed annotations
+    Returns:
+        LbxStore or iterator over the frames
+    """
+    if is_store(filepath):
+        return LbxStore.open(filepath)
+    if cache and last_frame(strparse(fstr)) is None:
+        # the whole file is parsed anyway, so it is cached for the next runs
+        return cache_store(filepath)
+    annotations = lookup_cache(filepath) if cache else None
+    if annotations is None:
+        # frames are parsed lazily up to the last required one
+        annotations = iter_frames(filepath)
+    return annotations
+
+
 # Convert the frame dict to the required yolo format and write it to disk
-def convert_to_yolo(jsfile, img_size, fstr, filename, outdir):
+def convert_to_yolo(jsfile, img_size, fstr, filename, outdir, shard_size=0):
     """
     Args:
-        jsfile (list): list from loaded json file
+        jsfile (iterable): list from loaded json file or iterator over its frames (see lbxReader.iter_frames)
         img_size (tuple): = (width, height) of the image/frame
         fstr (str): string of intervals <n1>-<n2>,<n3>-<n4>,<n5>...
         filename (str): future name of each txt file will take it as a beginning
         outdir (str): output directory for saving txt files
+        shard_size (int): number of txt files packed into one tar archive, 0 to write them separately
+    Returns:
+        {"frames": <number of written label files>, "objects": <number of written objects>,
+         "dropped": <number of objects dropped as low-confidence>,
+         "added", "changed", "removed": <number of label files added, rewritten and deleted in outdir>
+         unless the label files are packed into the archives}
     """
-    # go to an output directory
-    if not os.path.isdir(outdir):
-        os.makedirs(outdir)
-    cwd = os.getcwd()
-    os.chdir(os.path.join(cwd, outdir))
-
     framelst = strparse(fstr)
+    last = last_frame(framelst)
 
-    for [beginning, ending] in framelst:
-        ending = len(jsfile) if ending == '$' else ending
+    def in_range(num):
+        return any(int(beginning) <= num and (ending == '$' or num <= int(ending)) for beginning, ending in framelst)
 
-        try:
-            for i in range(int(beginning) - 1, int(ending)):
-                frame = jsfile[i]
-                print_buffer = []
-
-                # For each bounding box
-                for obj in frame['objects']:
-                    if class_name_to_id_mapping.get(obj["title"]):
-                        class_id = class_name_to_id_mapping[obj["title"]]
-                        b = obj['bbox']
-                        flag = 1  # used to check if object has an attribute = low-confidence
-                        if obj['classifications']:
-                            for cl in obj['classifications']:
-                                for answer in cl['answers']:
-                                    flag *= 0 if answer['value'] == 'low-confidence' else 1
-                        if not obj['classifications'] or flag:
-                            # Transform the bbox coordinates as per the format required by YOLO v5
-                            b_center_x = b["left"] + b["width"] / 2
-                            b_center_y = b["top"] + b["height"] / 2
-                            b_width = b["width"]
-                            b_height = b["height"]
-
-                            # Normalise the coordinates by the dimensions of the image
-                            image_w, image_h = img_size
-                            b_center_x /= image_w
-                            b_center_y /= image_h
-                            b_width /= image_w
-                            b_height /= image_h
-
-                            # Write the bbox details to the file
-                            print_buffer.append(
-                                "{} {:.3f} {:.3f} {:.3f} {:.3f}".format(class_id, b_center_x, b_center_y, b_width,
-                                                                        b_height))
-                # print("Invalid Class or uncategorized")
-                framenum = str(frame["frameNumber"])
-                # Save the annotation to disk
-                print("\n".join(print_buffer), file=open('{}_{}.txt'.format(filename, framenum), "w"))
-            print('saved as {}/{}_<number>.txt'.format(outdir, filename))
-        except IndexError:
-            print("WARNING: Invalid frame's range. Number of edited frames is {}".format(len(jsfile)))
+    def in_scope(name):
+        # only the label files of the requested frames are deleted if they are not produced anymore
+        number = name[len(filename) + 1:-len('.txt')]
+        return name.startswith(filename + '_') and number.isdigit() and in_range(int(number))
+
+    writer = ShardWriter(outdir, filename, shard_size) if shard_size else LabelDir(outdir, filename, in_scope)
+    stats = {'frames': 0, 'objects': 0, 'dropped': 0}
+
+    # the frames are walked once, the iterator is not consumed beyond the last required frame
+    num = 0
+    for frame in jsfile:
+        if last is not None and num >= last:
+            break
+        num += 1
+        if not in_range(num):
+            continue
+        print_buffer = []
+
+        # For each bounding box
+        for obj in frame['objects']:
+            if class_name_to_id_mapping.get(obj["title"]):
+                class_id = class_name_to_id_mapping[obj["title"]]
+                b = obj['bbox']
+                flag = 1  # used to check if object has an attribute = low-confidence
+                if obj['classifications']:
+                    for cl in obj['classifications']:
+                        for answer in cl['answers']:
+                            flag *= 0 if answer['value'] == 'low-confidence' else 1
+                if not obj['classifications'] or flag:
+                    # Transform the bbox coordinates as per the format required by YOLO v5
+                    b_center_x = b["left"] + b["width"] / 2
+                    b_center_y = b["top"] + b["height"] / 2
+                    b_width = b["width"]
+                    b_height = b["height"]
+
+                    # Normalise the coordinates by the dimensions of the image
+                    image_w, image_h = img_size
+                    b_center_x /= image_w
+                    b_center_y /= image_h
+                    b_width /= image_w
+                    b_height /= image_h
+
+                    # Write the bbox details to the file
+                    print_buffer.append(
+                        "{} {:.3f} {:.3f} {:.3f} {:.3f}".format(class_id, b_center_x, b_center_y, b_width,
+                                                                b_height))
+                else:
+                    stats['dropped'] += 1
+        # print("Invalid Class or uncategorized")
+        framenum = str(frame["frameNumber"])
+        # Save the annotation to disk
+        writer.write('{}_{}.txt'.format(filename, framenum), "\n".join(print_buffer) + "\n")
+        stats['frames'] += 1
+        stats['objects'] += len(print_buffer)
+    writer.close()
+    if shard_size:
+        print('saved as {}/{}-<shard>.tar of {}_<number>.txt'.format(outdir, filename, filename))
+    else:
+        # the label files are rewritten only if they are changed (see yoloShards.LabelDir)
+        stats.update(writer.changes)
+        print('saved as {}/{}_<number>.txt'.format(outdir, filename))
+    if last is not None and num < last:
+        print("WARNING: Invalid frame's range. Number of edited frames is {}".format(num))
+    return stats
+
+
+# convert one file, executed by the workers of the process pool
+def convert_file(filepath, img_size, fstr, outdir, cache=True, shard_size=0):
+    """
+    Args:
+        filepath (str): path to the json file or the annotation store
+        img_size (tuple): = (width, height) of the image/frame
+        fstr (str): string of intervals <n1>-<n2>,<n3>-<n4>,<n5>...
+        outdir (str): output directory for saving txt files
+        cache (bool): False if the json file should be parsed bypassing the cache of the parsed annotations
+        shard_size (int): number of txt files packed into one tar archive, 0 to write them separately
+    Returns:
+        statistics of convert_to_yolo extended by the "file" and the "seconds" spent on it
+    """
+    start = perf_counter()
+    filename = os.path.split(filepath)[1].rstrip('.json')
+    stats = convert_to_yolo(open_annotations(filepath, fstr, cache), img_size, fstr, filename, outdir,
+                            shard_size)
+    stats.update(file=filepath, seconds=perf_counter() - start)
+    return stats
+
+
+def print_summary(results):
+    """
+    Prints the statistics of the converted files and their totals.
+
+    Args:
+        results (list): statistics returned by convert_file
+    """
+    print("------------Summary-------------")
+    total = {'frames': 0, 'objects': 0, 'dropped': 0}
+    for stats in results:
+        for key in total:
+            total[key] += stats[key]
+        print("{}: frames {}, objects {}, low-confidence dropped {}, {:.1f} frames/s".format(
+            stats['file'], stats['frames'], stats['objects'], stats['dropped'],
+            stats['frames'] / stats['seconds'] if stats['seconds'] else 0))
+        if 'added' in stats:
+            print("    label files added {}, changed {}, removed {}".format(stats['added'], stats['changed'],
+                                                                        stats['removed']))
+    print("Total: frames {}, objects {}, low-confidence dropped {}".format(total['frames'], total['objects'],
+                                                                          total['dropped']))
+
+
+# merge the intervals of the 1-based frame positions into the sorted disjoint ones, '$' stands for the last frame
+def merge_intervals(framelst, total):
+    merged = []
+    for beginning, ending in sorted((int(beginning), total if ending == '$' else min(int(ending), total))
+                                    for beginning, ending in framelst):
+        if merged and beginning <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], ending)
+        else:
+            merged.append([beginning, ending])
+    return merged
+
+
+# count the keyframed classes and attributes of the objects of the frames first..last (1-based positions)
+def count_interval(store, first, last, cls_count, atr_count):
+    objects = slice(int(store.offsets[first - 1]), int(store.offsets[last]))
+    keyframe = store.keyframe[objects]
+    counts = np.bincount(store.cls[objects][keyframe], minlength=len(store.classes))
+    for ind, title in enumerate(store.classes):
+        if title in cls_count:
+            cls_count[title] += int(counts[ind])
+    # attribute values set on this frame
+    bits = store.attrs[objects] & store.attr_keyframes[objects]
+    for bit, value in enumerate(store.attributes):
+        if value in atr_count:
+            atr_count[value] += int(np.count_nonzero(bits & np.uint64(1 << bit)))
 
 
 # counts number of modified objects on frames, which were listed in the keyframes
-def count_objects(jsfile, keyframes, obj_cost):
+def count_objects(jsfile, keyframes, obj_cost, breakdown=False):
     """
-    jsfile: list from loaded json file
-    keyframes: string <n1>-<n2>,<n3>-<n4>,<n5>...
+    jsfile: list from loaded json file, iterator over its frames (see lbxReader.iter_frames) or LbxStore
+    keyframes: string <n1>-<n2>,<n3>-<n4>,<n5>..., the frames of the overlapping intervals are counted once
     obj_cost: cost of 1 annotation
+    breakdown: True if the counts should be printed for each interval as well
     :return: number of modified objects
     """
 
@@ -115,29 +245,21 @@ def count_objects(jsfile, keyframes, obj_cost):
 
     # find all the intervals or just separated frame numbers
     framelst = strparse(keyframes)
-    suma = 0
-    print_buffer = []
-
     for [beginning, ending] in framelst:
-        ending = len(jsfile) if ending == '$' or int(ending) > len(jsfile) else ending
-
-        if not (0 <= int(beginning) - 1 < int(ending)):
+        if int(beginning) < 1 or (ending != '$' and int(ending) < int(beginning)):
             raise IndexError("Invalid frame's range.")
-        for i in range(int(beginning) - 1, int(ending)):
-            frame = jsfile[i]
-            print_buffer.append(frame["frameNumber"])
-
-            # For each obj in frame
-            for obj in frame['objects']:
-                if obj['keyframe']:  # true, if was changed
-                    if obj['title'] in cls_count:
-                        cls_count[obj["title"]] += 1
-                if obj['classifications']:
-                    for classif in obj['classifications']:
-                        if classif['answers']:
-                            for answer in classif['answers']:
-                                if answer['value'] in atr_count and answer['keyframe']:
-                                    atr_count[answer['value']] += 1
+    # the counters are computed over the columns of the frames up to the last required one
+    store = jsfile if isinstance(jsfile, LbxStore) else LbxStore.from_frames(islice(jsfile, last_frame(framelst)))
+    num = len(store)
+    for [beginning, ending] in framelst:
+        if int(beginning) > num:
+            raise IndexError("Invalid frame's range.")
+    suma = 0
+
+    merged = merge_intervals(framelst, num)
+    for first, last in merged:
+        count_interval(store, first, last, cls_count, atr_count)
+    print_buffer = np.concatenate([store.frames[first - 1:last] for first, last in merged]).tolist()
 
     print_buffer.sort()
     print("Frames taken to account: ", print_buffer, "\n-----------Classes-----------")
@@ -147,6 +269,17 @@ def count_objects(jsfile, keyframes, obj_cost):
     print("----------Attributes----------")
     for key, value in atr_count.items():
         print("{}: {}".format(key, value))
+    if breakdown:
+        print("----------Intervals-----------")
+        for beginning, ending in framelst:
+            first, last = merge_intervals([(beginning, ending)], num)[0]
+            interval_cls = {key: 0 for key in cls_count}
+            interval_atr = {key: 0 for key in atr_count}
+            count_interval(store, first, last, interval_cls, interval_atr)
+            print("{}-{}: classes {} {}, attributes {} {}".format(
+                beginning, ending,
+                sum(interval_cls.values()), {key: value for key, value in interval_cls.items() if value},
+                sum(interval_atr.values()), {key: value for key, value in interval_atr.items() if value}))
     if obj_cost:
         print("------------Total-------------")
         print("""Total by class: {} \nCost: ${} \nTotal by attribute: {}""".format(suma,
@@ -160,7 +293,7 @@ if __name__ == '__main__':
                             formatter_class=ArgumentDefaultsHelpFormatter,
                             conflict_handler='resolve')
     parser.add_argument('-json-path', '--filepath', nargs='+',
-                        help='Path for json files', required=True)
+                        help='Path for json files or annotation stores (see lbxStore.py)', required=True)
     # parser.add_argument('-vid', '--vid-path', default=None,
     #                     help='Path for the video')
 
@@ -179,22 +312,36 @@ if __name__ == '__main__':
     group.add_argument('-k', '--keyframed-objects', action="store_true",
                        help='True if annotations should be counted')
 
+    parser.add_argument('--breakdown', action='store_true',
+                        help='Print the counts of each interval of the frames as well (with -k)')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Number of processes converting the json files in parallel')
+    parser.add_argument('--shard-size', type=int, default=0,
+                        help='Number of label files packed into one tar archive, 0 to write them separately')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='parse the json files bypassing the cache of the parsed annotations')
+    parser.add_argument('--clear-cache', action='store_true', help='clear the cache of the parsed annotations')
     args = parser.parse_args()
     # '-json-path /home/valia/AntVideos/Cflo_troph_count_masked_5-30_6-03-rand1.json -f 5-14 -k'.split())  # -f 1-4
 
-    for filepath in args.filepath:
-        with open(filepath) as jsonFile:
-            annotations = json.load(jsonFile)
-        # with open('data.json', 'w') as f:
-        #     json.dump(annotations[:6], f)
-        if args.keyframed_objects:
-            count_objects(annotations, args.frames, args.object_cost)
-        else:
-            try:
-                fm_size = tuple(map(lambda y: int(y), args.frame_size.split('x')))
-                filename = os.path.split(filepath)[1].rstrip('.json')
-                convert_to_yolo(annotations, fm_size, args.frames, filename, args.outp_dir)
-
-            except AttributeError:
-                print("AttributeError: can't convert annotations, unspecified argument value -s [FRAME_SIZE]." + \
-                      "\nTo count annotations in frame range specify -k [keyframed-objects] as True.")
+    if args.clear_cache:
+        clear_cache()
+    if args.keyframed_objects:
+        for filepath in args.filepath:
+            count_objects(open_annotations(filepath, args.frames, args.cache), args.frames, args.object_cost,
+                          args.breakdown)
+    else:
+        try:
+            fm_size = tuple(map(lambda y: int(y), args.frame_size.split('x')))
+            if args.jobs > 1 and len(args.filepath) > 1:
+                with ProcessPoolExecutor(args.jobs) as pool:
+                    results = list(pool.map(convert_file, args.filepath, repeat(fm_size), repeat(args.frames),
+                                            repeat(args.outp_dir), repeat(args.cache), repeat(args.shard_size)))
+            else:
+                results = [convert_file(filepath, fm_size, args.frames, args.outp_dir, args.cache, args.shard_size)
+                           for filepath in args.filepath]
+            print_summary(results)
+
+        except AttributeError:
+            print("AttributeError: can't convert annotations, unspecified argument value -s [FRAME_SIZE]." + \
+                  "\nTo count annotations in frame range specify -k [keyframed-objects] as True.")
@@ -7,17 +7,25 @@
 :Date: 2022-03-25
 """
 import os.path
+import threading
+from collections import OrderedDict
 
 import cv2
 import json
 import numpy as np
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
-from visAnnotDiff import dashrect
+from visAnnotDiff import Overlay, hex2bgr
+from lbxStore import load_annotations, clear_cache
+from videoIndex import VideoSeeker
 from re import findall
 
+# number of the frames with the cached bboxes for the hit testing
+HITBOX_FRAMES = 64
 
-def visualize_bbox(image: np.ndarray, tool, bold=False, dashed=False, thickness: int = 2) -> np.ndarray:
+
+def visualize_bbox(image: np.ndarray, tool, bold=False, dashed=False, thickness: int = 2,
+                   overlay: Overlay = None) -> np.ndarray:
     """
     Draws a bounding box on an image
 
@@ -25,6 +33,7 @@ def visualize_bbox(image: np.ndarray, tool, bold=False, dashed=False, thickness:
         image (np.ndarray): image to draw a bounding box onto
         tool (Dict[str,any]): Dict response from the export
         bold (str): False if rectangle should be without bold boundaries
+        overlay (Overlay): the bbox and its label are added to the overlay drawn later instead of the image
     Returns:
         image with a bounding box drawn on it.
     """
@@ -32,41 +41,159 @@ def visualize_bbox(image: np.ndarray, tool, bold=False, dashed=False, thickness:
     end = (int(tool['bbox']["left"] + tool['bbox']["width"]),
            int(tool['bbox']["top"] + tool['bbox']["height"]))
 
-    if 'color' in tool.keys():
-        h = tool['color'].lstrip('#')
-        color = tuple(int(h[i:i + 2], 16) for i in (4, 2, 0))  # BGR
-    else:
-        color = (0, 0, 1)
+    color = hex2bgr(tool['color']) if 'color' in tool.keys() else (0, 0, 1)
 
     k = 1 if not bold else 2
-    if not dashed:
-        cv2.rectangle(image, start, end, color, thickness * k)
-    else:
-        dashrect(image, start, end, color, thickness * k, 'dashed')
+    drawn = overlay if overlay is not None else Overlay()
+    drawn.rect(start, end, color, thickness * k, 'dashed' if dashed else '')
 
     if tool['value'] == "ant":  # tool['id'][:2] != "ah" and tool['id'][0] == "a":
-        cv2.putText(image, tool['featureId'], (start[0], end[1]),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.8, color, 1 * k)
+        drawn.text(tool['featureId'], (start[0], end[1]), color, 0.8, 1 * k)
     else:
-        cv2.putText(image, tool['featureId'], (start[0], start[1] - 3),
-                    cv2.FONT_HERSHEY_SIMPLEX, 0.8, color, 1 * k)
+        drawn.text(tool['featureId'], (start[0], start[1] - 3), color, 0.8, 1 * k)
+
+    return image if overlay is not None else drawn.draw(image)
+
+
+class FrameCache:
+    """
+    Bounded LRU cache of the decoded frames of the video.
+    The background thread prefetches the frames around the requested one, mostly in the direction of travel,
+    decoding them sequentially, so stepping through the video does not seek.
+
+    Args:
+        video (str): path to the video
+        budget (float): memory budget of the cached frames in MB
+        prefetch (int): number of frames decoded ahead of the requested one, a quarter of them is decoded behind it
+    """
+
+    def __init__(self, video: str, budget: float = 1024, prefetch: int = 16):
+        self.vid = VideoSeeker(video)
+        self.count = self.vid.count
+        self.frames = OrderedDict()
+        self.budget = int(budget * 2 ** 20)
+        self.size = 0  # bytes of the cached frames
+        self.next = 0  # position of the frame read by the decoder next
+        self.pos = 0
+        self.direction = 1
+        self.stats = {'hits': 0, 'misses': 0, 'prefetched': 0}
+        self.lock = threading.Lock()  # guards the cache and the position of the user
+        self.decoding = threading.Lock()  # guards the decoder
+        self.wake = threading.Condition(self.lock)
+        self.stopped = False
+
+        self.ahead = 0
+        first = self.get(0)
+        # the window of the prefetched frames has to fit into the budget
+        self.ahead = max(0, min(prefetch, self.budget // max(1, first.nbytes) // 2 - 1))
+        self.behind = self.ahead // 4
+        self.worker = threading.Thread(target=self._prefetch, daemon=True)
+        self.worker.start()
+
+    def _store(self, pos: int, frame: np.ndarray):
+        # called under the lock
+        if pos in self.frames:
+            return
+        self.frames[pos] = frame
+        self.size += frame.nbytes
+        while self.size > self.budget and len(self.frames) > 1:
+            _, old = self.frames.popitem(last=False)
+            self.size -= old.nbytes
+
+    def _decode(self, pos: int) -> np.ndarray:
+        with self.decoding:
+            # the frame could be prefetched while the decoder was busy
+            with self.lock:
+                frame = self.frames.get(pos)
+            if frame is not None:
+                return frame
+            # the close frames are decoded forward instead of the seek to the previous keyframe
+            if not self.next <= pos <= self.next + self.ahead:
+                self.next = pos
+            while self.next <= pos:
+                ok, frame = self.vid.read(self.next)
+                if not ok:
+                    return None
+                with self.lock:
+                    self._store(self.next, frame)
+                self.next += 1
+        return frame
+
+    def get(self, pos: int) -> np.ndarray:
+        """
+        Returns the decoded frame of the position and moves the prefetch window to it.
+        """
+        with self.lock:
+            self.direction = -1 if pos < self.pos else 1 if pos > self.pos else self.direction
+            self.pos = pos
+            frame = self.frames.get(pos)
+            if frame is not None:
+                self.frames.move_to_end(pos)
+                self.stats['hits'] += 1
+            else:
+                self.stats['misses'] += 1
+            self.wake.notify()
+        return frame if frame is not None else self._decode(pos)
+
+    def _missing(self):
+        # called under the lock, the next frame to prefetch or None
+        ahead = range(self.pos, min(self.pos + self.ahead, self.count - 1) + 1)
+        behind = range(self.pos - 1, max(self.pos - self.behind, 0) - 1, -1)
+        if self.direction < 0:
+            ahead = range(self.pos, max(self.pos - self.ahead, 0) - 1, -1)
+            behind = range(self.pos + 1, min(self.pos + self.behind, self.count - 1) + 1)
+        for window in (ahead, behind):
+            missing = [pos for pos in window if pos not in self.frames]
+            if not missing:
+                continue
+            if window.step > 0:
+                return missing[0]
+            # the frames behind are decoded forward from the earliest one of the gap
+            first = missing[0]
+            while first - 1 in window and first - 1 not in self.frames:
+                first -= 1
+            return first
+        return None
+
+    def _prefetch(self):
+        while True:
+            with self.lock:
+                pos = self._missing()
+                while not self.stopped and pos is None:
+                    self.wake.wait()
+                    pos = self._missing()
+                if self.stopped:
+                    return
+            if self._decode(pos) is None:
+                with self.lock:
+                    self.count = min(self.count, pos)
+            else:
+                self.stats['prefetched'] += 1
 
-    return image
+    def close(self):
+        with self.lock:
+            self.stopped = True
+            self.wake.notify()
+        self.worker.join()
+        self.vid.release()
+        lookups = self.stats['hits'] + self.stats['misses']
+        print('Frame cache: {} hits, {} misses ({:.1%} hit rate), {} prefetched frames, {} seeks, {} frames cached'
+              .format(self.stats['hits'], self.stats['misses'], self.stats['hits'] / max(1, lookups),
+                      self.stats['prefetched'], self.vid.seeks, len(self.frames)))
 
 
 class App:
-    def __init__(self, video, filepath, horizontal=True, w0=1880, h0=1021):
+    def __init__(self, video, filepath, horizontal=True, w0=1880, h0=1021, cache=True, cache_mb=1024, prefetch=16):
 
-        with open(filepath, 'r') as f:
-            self.file = json.load(f)
+        self.file = load_annotations(filepath, cache)
 
         self.horizontal = horizontal
         self.w0 = w0
         self.vidpath = video
-        self.vid = cv2.VideoCapture(video)
+        self.vid = FrameCache(video, cache_mb, prefetch)
         # left (first frame) and right frame (next frame) respectively
-        _, self.fframe = self.vid.read()
-        _, self.nframe = self.vid.read()
+        self.fframe = self.vid.get(0)
+        self.nframe = self.vid.get(1)
 
         # self.notClear = {'2': ['a2', 'ah5']}    # will be changed after another script will become completed
         self.notClear = {}
@@ -77,6 +204,9 @@ class App:
         self.trackerPos = 0
 
         self.lastevent = None
+        self.moved = None  # the last mouse position not handled yet
+        self.highlight = ''
+        self.hitboxes = OrderedDict()  # bboxes of the recently hovered frames
         self.tochange = None
         self.roi = None  # coordinates of the ROI
         self.pic = None  # coordinates of the ROI
@@ -107,7 +237,7 @@ class App:
 
         self.drawRoi()
         cv2.createTrackbar(self.trTitle, self.windowName, 0,
-                           int(self.vid.get(cv2.CAP_PROP_FRAME_COUNT)) - 2,
+                           self.vid.count - 2,
                            # -2 because we start from 0, and we show 2 frames at one time
                            self.trackbar)
         cv2.setMouseCallback(self.windowName, self.react)
@@ -121,6 +251,9 @@ class App:
               '-- To remove the bbox press Del \n')
         while 1:
             key = cv2.waitKey(1)
+            if self.moved is not None:
+                self.handle(cv2.EVENT_MOUSEMOVE, *self.moved)
+                self.moved = None
             # Quit: escape or q
 
             if key in (27, ord('q')):
@@ -133,12 +266,13 @@ class App:
                     filename = filepath.rstrip('.json') + '_imp_{}.json'.format(i)
 
                 with open(filename, 'w') as f:
-                    json.dump(self.file, f)
+                    json.dump(list(self.file), f)
                 cv2.destroyAllWindows()
+                self.vid.close()
                 break
             elif key == 255:  # Del
                 self.react(x=0, y=0, event=cv2.EVENT_RBUTTONUP)
-            elif key == ord('n') and self.trackerPos < int(self.vid.get(cv2.CAP_PROP_FRAME_COUNT)) - 3:
+            elif key == ord('n') and self.trackerPos < self.vid.count - 3:
                 self.trackbar(self.trackerPos + 1)
             elif key == ord('p') and self.trackerPos > 0:
                 self.trackbar(self.trackerPos - 1)
@@ -149,8 +283,38 @@ class App:
                 self.roimode = True
                 print('You have switched the to drawing ROI mode')
 
+    def boxes(self, pos: int) -> np.ndarray:
+        """
+        Integer (left, top, right, bottom) of the bboxes of the frame, built on the first hover and cached.
+        """
+        objects = self.file[pos]['objects']
+        boxes = self.hitboxes.get(pos)
+        if boxes is None or len(boxes) != len(objects):
+            boxes = np.array([(int(obj['bbox']["left"]), int(obj['bbox']["top"]),
+                               int(obj['bbox']["left"] + obj['bbox']["width"]),
+                               int(obj['bbox']["top"] + obj['bbox']["height"])) for obj in objects],
+                             dtype=np.int64).reshape(-1, 4)
+            self.hitboxes[pos] = boxes
+            while len(self.hitboxes) > HITBOX_FRAMES:
+                self.hitboxes.popitem(last=False)
+        self.hitboxes.move_to_end(pos)
+        return boxes
+
+    def hit(self, pos: int, x: int, y: int) -> str:
+        """
+        Returns:
+            featureId of the smallest bbox of the frame containing the point or ''
+        """
+        boxes = self.boxes(pos)
+        inside = np.flatnonzero((boxes[:, 0] < x) & (x < boxes[:, 2]) & (boxes[:, 1] < y) & (y < boxes[:, 3]))
+        if not len(inside):
+            return ''
+        areas = (boxes[inside, 2] - boxes[inside, 0]) * (boxes[inside, 3] - boxes[inside, 1])
+        return self.file[pos]['objects'][inside[np.argmin(areas)]]['featureId']
+
     def react(self, event, x, y, flags=None, params=None):
-        """Mouse callback to choose ROIs to correct their Id's
+        """Mouse callback to choose ROIs to correct their Id's.
+        The mouse movements are coalesced: only the last position is handled by the main loop once per frame.
 
         event  - mouse event
         x: int  - x coordinate
@@ -158,37 +322,27 @@ class App:
         flags  - additional flags
         params - extra parameters
         """
-
-        ids = []
-        onmouse = ''
-
+        if event == cv2.EVENT_MOUSEMOVE:
+            self.moved = (x, y)
+            return
+        if self.moved is not None:
+            self.handle(cv2.EVENT_MOUSEMOVE, *self.moved)
+            self.moved = None
+        self.handle(event, x, y)
+
+    def handle(self, event, x, y):
+        """Handles the mouse event, see react"""
         if self.horizontal:
             k = 1 if x > self.w else 0
-            for obj in self.file[self.trackerPos + k]['objects']:
-                start = (int(obj['bbox']["left"]), int(obj['bbox']["top"]))
-                end = (int(obj['bbox']["left"] + obj['bbox']["width"]),
-                       int(obj['bbox']["top"] + obj['bbox']["height"]))
-                if start[0] < x - self.w * k < end[0] and start[1] < y < end[1]:
-                    s = (np.array(start) - np.array(end))[0] * (np.array(start) - np.array(end))[1]
-                    ids.append([obj['featureId'], s])
+            onmouse = self.hit(self.trackerPos + k, x - self.w * k, y)
         else:
             k = 1 if y > self.h else 0
-            for obj in self.file[self.trackerPos + k]['objects']:
-                start = (int(obj['bbox']["left"]), int(obj['bbox']["top"]))
-                end = (int(obj['bbox']["left"] + obj['bbox']["width"]),
-                       int(obj['bbox']["top"] + obj['bbox']["height"]))
-                if start[0] < x < end[0] and start[1] < y - self.h * k < end[1]:
-                    s = (np.array(start) - np.array(end))[0] * (np.array(start) - np.array(end))[1]
-                    ids.append([obj['featureId'], s])
-        if ids:
-            def findmin(l):
-                res = None if not l else l[0]
-                for pair in l:
-                    if res[1] > pair[1]:
-                        res = pair.copy()
-                return res[0]
-
-            onmouse = findmin(ids)
+            onmouse = self.hit(self.trackerPos + k, x, y - self.h * k)
+
+        if event == cv2.EVENT_MOUSEMOVE and not self.draw and onmouse == self.highlight:
+            # nothing to redraw
+            self.lastevent = event
+            return
 
         if event == cv2.EVENT_LBUTTONDBLCLK:
             print('hello')
@@ -206,7 +360,7 @@ class App:
                     self.tochange = None
             else:
                 if self.tochange and ((self.horizontal and x < self.w) or (not self.horizontal and y < self.h)):
-                    for j in range(self.trackerPos + 1, int(self.vid.get(cv2.CAP_PROP_FRAME_COUNT))):
+                    for j in range(self.trackerPos + 1, self.vid.count):
                         indexSwitch = {'old': -1,
                                        'new': -1}
                         for i, obj in enumerate(self.file[j]['objects']):
@@ -258,6 +412,7 @@ class App:
             self.mask *= 0
 
         self.lastevent = event
+        self.highlight = onmouse
         self.drawRoi(onmouse)
 
     def drawRoi(self, highlight=''):
@@ -276,6 +431,7 @@ class App:
             cv2.putText(img[i], str(self.trackerPos + i), (0, 35),
                         cv2.FONT_HERSHEY_SIMPLEX, 1.2, (255, 0, 0), 4)
 
+            overlay = Overlay()
             for obj in self.file[self.trackerPos + i]['objects']:
                 bold = True if obj['featureId'] == highlight else False
                 dashed = True if obj['featureId'] == self.tochange and i == 1 else False
@@ -284,7 +440,8 @@ class App:
                 #         dashed = True if obj['featureId'] in self.notClear[str(self.trackerPos + 2)] else False
                 #     except KeyError:
                 #         pass
-                img[i] = visualize_bbox(img[i], obj, thickness=rt, bold=bold, dashed=dashed)
+                visualize_bbox(img[i], obj, thickness=rt, bold=bold, dashed=dashed, overlay=overlay)
+            overlay.draw(img[i])
 
         if self.horizontal:
             img = np.hstack(img)
@@ -311,6 +468,7 @@ class App:
 
         # ----------------------- lines due to features --------------------------
         if self.linemode in ('2', '1'):
+            overlay = Overlay()
             # obj_in_area = 0
             for p_obj in self.file[self.trackerPos]['objects']:
                 mid = (int(p_obj['bbox']["left"] + p_obj['bbox']["width"] / 2),
@@ -322,14 +480,16 @@ class App:
                             bold = True if p_obj['featureId'] == highlight else False
                             if (self.linemode == '2' and bold) or self.linemode == '1':
                                 # obj_in_area += 1 if self.mode == '2' and bold else 0
-                                img = self.visualize_line(img, p_obj, n_obj, thickness=rt, bold=bold)
+                                self.visualize_line(img, p_obj, n_obj, thickness=rt, bold=bold, overlay=overlay)
                                 # if obj_in_area == 2:
                                 #     cv2.imshow(self.windowName, img)
                                 #     return 0
+            overlay.draw(img)
 
         cv2.imshow(self.windowName, img)
 
-    def visualize_line(self, image: np.ndarray, p_obj, n_obj, bold=False, thickness: int = 2) -> np.ndarray:
+    def visualize_line(self, image: np.ndarray, p_obj, n_obj, bold=False, thickness: int = 2,
+                       overlay: Overlay = None) -> np.ndarray:
         """
         Draws a bounding box on an image
 
@@ -337,6 +497,7 @@ class App:
             image (np.ndarray): image to draw a bounding box onto
             tool (Dict[str,any]): Dict response from the export
             bold (str): False if rectangle should be without bold boundaries
+            overlay (Overlay): the line is added to the overlay drawn later instead of the image
         Returns:
             image with a bounding box drawn on it.
         """
@@ -350,14 +511,13 @@ class App:
             end = (int(n_obj['bbox']["left"] + n_obj['bbox']["width"] / 2),
                    int(n_obj['bbox']["top"] + n_obj['bbox']["height"] / 2 + self.h))
 
-        if 'color' in p_obj.keys():
-            h = p_obj['color'].lstrip('#')
-            color = tuple(int(h[i:i + 2], 16) for i in (4, 2, 0))  # BGR
-        else:
-            color = (0, 0, 1)
+        color = hex2bgr(p_obj['color']) if 'color' in p_obj.keys() else (0, 0, 1)
 
         k = 1 if not bold else 2
-        cv2.line(image, start, end, color=color, thickness=thickness * k)
+        if overlay is not None:
+            overlay.line(start, end, color, thickness * k)
+        else:
+            cv2.line(image, start, end, color=color, thickness=thickness * k)
 
         return image
 
@@ -367,9 +527,10 @@ class App:
         val (str): new trackbar position
         """
         self.trackerPos = val
-        self.vid.set(cv2.CAP_PROP_POS_FRAMES, int(val))
-        _, self.fframe = self.vid.read()
-        _, self.nframe = self.vid.read()
+        self.fframe = self.vid.get(int(val))
+        self.nframe = self.vid.get(int(val) + 1)
+        # the new frame is drawn without the highlight, the next hover has to draw it
+        self.highlight = ''
         self.drawRoi()
 
 
@@ -381,13 +542,19 @@ if __name__ == '__main__':
                         type=str, help='path to video')
     parser.add_argument('-a', '--annotations',
                         default='test-parameters/Cflo_troph_count_masked_6-00_6-31_MAL_withId.json',
-                        type=str, help='path to the MAL annotations')
+                        type=str, help='path to the MAL annotations or their store')
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-hor', '--horizontal', action="store_true",help="type of images' stack")
     group.add_argument('-ver', '--vertical', action="store_true", help="type of images' stack")
 
     parser.add_argument('-wsize', type=str, default="1600x1200", help='Your screen parameters WxH')
 
+    parser.add_argument('--cache-mb', type=float, default=1024, help='Memory budget of the decoded frames in MB')
+    parser.add_argument('--prefetch', type=int, default=16,
+                        help='Number of frames decoded in the background ahead of the current one')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='parse the json files bypassing the cache of the parsed annotations')
+    parser.add_argument('--clear-cache', action='store_true', help='clear the cache of the parsed annotations')
     print()
     opt = parser.parse_args()
     # using test-parameters
@@ -398,4 +565,6 @@ if __name__ == '__main__':
     w, h = opt.wsize.split('x')
     flag = True if opt.horizontal else False
     flag = True if not opt.horizontal and not opt.vertical else flag
-    App(opt.video, opt.annotations, flag, int(w), int(h))
+    if opt.clear_cache:
+        clear_cache()
+    App(opt.video, opt.annotations, flag, int(w), int(h), opt.cache, opt.cache_mb, opt.prefetch)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+:Description: Regression check of validAnnotations.py on the annotations of test-parameters.
+
+:Authors: (c) Valentyna Pryhodiuk <vpryhodiuk@lumais.com>
+:Date: 2026-10-17
+"""
+import copy
+import os
+import unittest
+from contextlib import redirect_stdout
+from io import StringIO
+from json import load
+
+from validAnnotations import valid
+
+TEST_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test-parameters',
+                         'Cflo_troph_count_masked_6-00_6-31_MAL_withId.json')
+# body with three heads inside it on the same number of frames
+AMBIGUOUS_BODY = 'cl0wkmpdo9yb40zcl5ad2aeyk'
+AMBIGUOUS_HEADS = ('cl0wkmpdo9ya90zcl6lyb39m2', 'cl0wkmpdo9yab0zclho8n4l0b', 'cl0wkmpdo9yb30zcl2v8479dh')
+
+
+class TestValid(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        with open(TEST_FILE, 'r') as file:
+            cls.source = load(file)
+        cls.jsfile = copy.deepcopy(cls.source)
+        with redirect_stdout(StringIO()) as out:
+            cls.anthill = valid(cls.jsfile, outpath=None)
+        cls.report = out.getvalue()
+
+    def test_ants(self):
+        self.assertEqual(len(self.anthill), 4)
+        self.assertEqual({(self.anthill.feature2num[ant.body], self.anthill.feature2num[ant.head], ant.appears)
+                          for ant in self.anthill}, {(1, 9, 930), (2, 7, 930), (3, 8, 930), (4, 10, 930)})
+
+    def test_ambiguous_ties(self):
+        # the tie is reported, but neither the body nor its heads are assigned or corrected
+        self.assertIn('WARNING: ambiguous body featureId ' + AMBIGUOUS_BODY, self.report)
+        self.assertFalse(self.anthill.isbody(AMBIGUOUS_BODY))
+        for frame, source in zip(self.jsfile, self.source):
+            for obj, sobj in zip(frame['objects'], source['objects']):
+                if obj['featureId'] in AMBIGUOUS_HEADS + (AMBIGUOUS_BODY,):
+                    self.assertEqual(obj['bbox'], sobj['bbox'])
+
+
+if __name__ == '__main__':
+    unittest.main()
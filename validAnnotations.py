@@ -1,11 +1,19 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+import os
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from bisect import bisect_right
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from itertools import repeat
 from json import load, dump
 from typing import Dict
+import numpy as np
+from lbxStore import LbxStore, clear_cache, is_store, load_annotations, store_path
 
-feature2num = {}
+# number of frames processed by a worker in the batch mode
+SHARD_SIZE = 10000
 
 
 def shorten_file(jsFile: str) -> Dict[str, list]:
@@ -25,7 +33,7 @@ def shorten_file(jsFile: str) -> Dict[str, list]:
         annotDict[frameNum] = dict()
         for obj in frame['objects']:
             feature_id = obj['featureId']
-            annotDict[frameNum][feature_id] = Annotation(obj['bbox'], obj['color'], obj['keyframe'])
+            annotDict[frameNum][feature_id] = Annotation(obj['bbox'], obj.get('color'), obj['keyframe'])
     return annotDict
 
 
@@ -35,7 +43,7 @@ class Ant:
         self.head = head
         self.appears = num
 
-    def print(self):
+    def print(self, feature2num):
         # print("Ant(body = {}, head = {}, appears = {})".format(self.body, self.head, self.appears))
         print("Ant(body = {}, head = {}, appears = {})".format(feature2num[self.body],
                                                                feature2num[self.head],
@@ -43,6 +51,9 @@ class Ant:
 
 
 class AntList(list):
+    # numbers of the featureIds used for printing (see scan_labels)
+    feature2num = {}
+
     def ishead(self, head):
         for ant in self:
             if ant.head == head:
@@ -71,14 +82,222 @@ class AntList(list):
 
     def print(self):
         for ant in self:
-            ant.print()
+            ant.print(self.feature2num)
 
 
-def valid(jsfile, roifile=[]):
-    global feature2num
-    annot = shorten_file(jsfile)
-    anthill = AntList()
-    notsure = AntList()
+def associate(annot: Dict[int, dict], bodies: list, heads: list) -> AntList:
+    """
+    Counts the frames where the centre of the head lies inside the box of the body for every (body, head) pair.
+    The containment is computed per frame by broadcasting the body boxes against the head centres,
+    and the counts are accumulated as a sparse (body, head) matrix.
+
+    Args:
+        annot (dict): annotations returned by shorten_file
+        bodies (list): featureIds of the bodies
+        heads (list): featureIds of the heads
+    Returns:
+        AntList of the pairs with the number of frames they appear in, ordered by the first appearance
+        (frames, then bodies and heads in the order of the lists)
+    """
+    bodyrank = {featureId: i for i, featureId in enumerate(bodies)}
+    headrank = {featureId: i for i, featureId in enumerate(heads)}
+    pairs = []
+    for num, frame in enumerate(annot.values()):
+        bodyIds = [featureId for featureId in frame if featureId in bodyrank]
+        headIds = [featureId for featureId in frame if featureId in headrank]
+        if not bodyIds or not headIds:
+            continue
+        bbox = np.array([[frame[featureId].bbox[key] for key in ('left', 'top', 'width', 'height')]
+                         for featureId in bodyIds])
+        hbox = np.array([[frame[featureId].bbox[key] for key in ('left', 'top', 'width', 'height')]
+                         for featureId in headIds])
+        bLeft, bTop = bbox[:, 0:1], bbox[:, 1:2]
+        bRight, bBottom = bLeft + bbox[:, 2:3], bTop + bbox[:, 3:4]
+        hCenter_x = hbox[:, 0] + hbox[:, 2] / 2
+        hCenter_y = hbox[:, 1] + hbox[:, 3] / 2
+        inside = (bLeft < hCenter_x) & (hCenter_x < bRight) & (bTop < hCenter_y) & (hCenter_y < bBottom)
+        bi, hi = np.nonzero(inside)
+        pairs.append(np.stack([np.full(len(bi), num),
+                               np.array([bodyrank[featureId] for featureId in bodyIds])[bi],
+                               np.array([headrank[featureId] for featureId in headIds])[hi]]))
+    if not pairs:
+        return AntList()
+
+    frame, body, head = np.concatenate(pairs, axis=1)
+    order = np.lexsort((head, body, frame))
+    # (body, head) cells of the sparse count matrix
+    cells, first, counts = np.unique((body * len(heads) + head)[order], return_index=True, return_counts=True)
+    ants = AntList()
+    for ind in np.argsort(first, kind='stable'):
+        bodyind, headind = divmod(int(cells[ind]), len(heads))
+        list.append(ants, Ant(bodies[bodyind], heads[headind], int(counts[ind])))
+    return ants
+
+
+def max_assignment(weights: np.ndarray) -> np.ndarray:
+    """
+    Solves the assignment problem maximizing the total weight by the Hungarian method
+    with the shortest augmenting paths (Jonker-Volgenant), vectorised over the columns.
+
+    Args:
+        weights (np.ndarray): matrix of the weights of the rows and columns
+    Returns:
+        column assigned to each row, -1 if the row is not assigned (more rows than columns)
+    """
+    if weights.shape[0] > weights.shape[1]:
+        cols = max_assignment(weights.T)
+        rows = np.full(weights.shape[0], -1)
+        rows[cols] = np.arange(len(cols))
+        return rows
+    cost = -np.asarray(weights, dtype=np.float64)
+    n, m = cost.shape
+    # potentials of the rows and columns, the rows assigned to the columns (1-based, 0 is the fictive column)
+    u, v = np.zeros(n + 1), np.zeros(m + 1)
+    p, way = np.zeros(m + 1, dtype=int), np.zeros(m + 1, dtype=int)
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while p[j0]:
+            used[j0] = True
+            free = ~used[1:]
+            cur = cost[p[j0] - 1] - u[p[j0]] - v[1:]
+            better = free & (cur < minv[1:])
+            minv[1:][better] = cur[better]
+            way[1:][better] = j0
+            reduced = np.where(free, minv[1:], np.inf)
+            j1 = int(np.argmin(reduced)) + 1
+            delta = reduced[j1 - 1]
+            u[p[used]] += delta
+            v[used] -= delta
+            minv[1:][free] -= delta
+            j0 = j1
+        # augment along the path
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+    rows = np.full(n, -1)
+    assigned = np.flatnonzero(p[1:])
+    rows[p[1:][assigned] - 1] = assigned
+    return rows
+
+
+def assign_heads(notsure: AntList, min_support: int = 1) -> AntList:
+    """
+    Assigns at most one head to each body maximizing the total number of frames where the heads
+    lie inside their bodies. The pairs are split into the connected components, which are solved separately.
+    Ambiguous ties (the body with several best heads or the head with several best bodies) are reported
+    and left unassigned.
+
+    Args:
+        notsure (AntList): candidate pairs returned by associate
+        min_support (int): minimal number of frames where the head should lie inside the body
+    Returns:
+        AntList of the assigned pairs ordered by the bodies
+    """
+    pairs = [ant for ant in notsure if ant.appears >= min_support]
+    # connected components of the bipartite graph of the pairs
+    parent = {}
+
+    def find(node):
+        while parent.setdefault(node, node) != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    for ant in pairs:
+        parent[find(('body', ant.body))] = find(('head', ant.head))
+    components = {}
+    for ant in pairs:
+        components.setdefault(find(('body', ant.body)), []).append(ant)
+
+    anthill = []
+    for component in components.values():
+        bodies = sorted({ant.body for ant in component})
+        heads = sorted({ant.head for ant in component})
+        weights = np.zeros((len(bodies), len(heads)), dtype=np.int64)
+        for ant in component:
+            weights[bodies.index(ant.body), heads.index(ant.head)] = ant.appears
+        # the ambiguous bodies and heads are reported and left unassigned, so they are not corrected
+        certain = weights.copy()
+        for row, body in enumerate(bodies):
+            best = np.flatnonzero(weights[row] == weights[row].max())
+            if len(best) > 1:
+                print('WARNING: ambiguous body featureId {}, heads {} appear inside it on {} frames each'.format(
+                    body, ', '.join(heads[col] for col in best), weights[row].max()))
+                certain[row] = 0
+        for col, head in enumerate(heads):
+            best = np.flatnonzero(weights[:, col] == weights[:, col].max())
+            if len(best) > 1:
+                print('WARNING: ambiguous head featureId {}, it appears inside bodies {} on {} frames each'.format(
+                    head, ', '.join(bodies[row] for row in best), weights[:, col].max()))
+                certain[:, col] = 0
+
+        for row, col in enumerate(max_assignment(certain)):
+            if col >= 0 and certain[row, col]:
+                anthill.append(Ant(bodies[row], heads[col], int(certain[row, col])))
+    return AntList(sorted(anthill, key=lambda ant: ant.body))
+
+
+def feature_index(jsfile) -> Dict[str, list]:
+    """
+    Indexes the occurrences of the objects in one pass.
+
+    Args:
+        jsfile (list): list of the frames or LbxStore
+    Returns:
+        {<feature_id>: [(<frame position>, <object position>), ...]} in the order of the frames
+    """
+    index = {}
+    for num, frame in enumerate(jsfile):
+        for pos, obj in enumerate(frame['objects']):
+            index.setdefault(obj['featureId'], []).append((num, pos))
+    return index
+
+
+class RoiIndex:
+    """
+    Interval lookup of the ROIs [{"interval": [<first frame>, <last frame>], "ROI": [<left>, <top>, <width>, <height>]}]
+    active on the frame. The frame numbers are split into the spans with the same active ROIs.
+    """
+
+    def __init__(self, roifile: list):
+        bounds = sorted({roi['interval'][0] for roi in roifile} | {roi['interval'][1] + 1 for roi in roifile})
+        self.starts = bounds
+        self.active_rois = [[tuple(roi['ROI'][:4]) for roi in roifile
+                             if roi['interval'][0] <= start <= roi['interval'][1]] for start in bounds]
+
+    def active(self, frameNumber: int) -> list:
+        ind = bisect_right(self.starts, frameNumber) - 1
+        return self.active_rois[ind] if ind >= 0 else []
+
+
+def dump_frames(frames, path: str):
+    """
+    Writes the frames to the json file one by one, without building the whole document in memory.
+    """
+    with open(path, 'w') as file:
+        file.write('[')
+        for num, frame in enumerate(frames):
+            if num:
+                file.write(', ')
+            dump(frame, file)
+        file.write(']')
+
+
+def scan_labels(jsfile) -> tuple:
+    """
+    Collects the featureIds of the bodies and heads with their numbers among the objects
+    of the same class on the frame.
+
+    Args:
+        jsfile (list): list of the frames or LbxStore
+    Returns:
+        bodies (set), heads (set), feature2num {<feature_id>: <maximal number on the frames>}
+    """
+    feature2num = {}
     heads = set()
     bodies = set()
     for frame in jsfile:
@@ -87,118 +306,221 @@ def valid(jsfile, roifile=[]):
         for object in frame['objects']:
             if object['value'] == 'ant':
                 bodies.add(object['featureId'])
-                feature2num[object['featureId']] = body_num if not object['featureId'] in feature2num else max(body_num,
-                                                                                                               feature2num[
-                                                                                                                   object[
-                                                                                                                       'featureId']])
+                feature2num[object['featureId']] = max(body_num, feature2num.get(object['featureId'], 0))
                 body_num += 1
             elif object['value'] == 'ant-head':
                 heads.add(object['featureId'])
-                feature2num[object['featureId']] = head_num if not object['featureId'] in feature2num else max(head_num,
-                                                                                                               feature2num[
-                                                                                                                   object[
-                                                                                                                       'featureId']])
+                feature2num[object['featureId']] = max(head_num, feature2num.get(object['featureId'], 0))
                 head_num += 1
+    return bodies, heads, feature2num
 
-    for frame in annot.values():
-        for bodyId in bodies:
-            if bodyId in frame:
-                bLeft, bRight = frame[bodyId].bbox['left'], frame[bodyId].bbox['left'] + frame[bodyId].bbox['width']
-                bTop, bBottom = frame[bodyId].bbox['top'], frame[bodyId].bbox['top'] + frame[bodyId].bbox['height']
-                for headId in heads:
-                    if headId in frame:
-                        hCenter_x = frame[headId].bbox['left'] + frame[headId].bbox['width'] / 2
-                        hCenter_y = frame[headId].bbox['top'] + frame[headId].bbox['height'] / 2
-                        if bLeft < hCenter_x < bRight and bTop < hCenter_y < bBottom:
-                            ant = Ant(bodyId, headId)
-                            notsure.append(ant)
-    for _ in range(3):
-        for bodyId in bodies:
-            best = AntList([Ant(bodyId, '-0', 0)])
-            for ant in notsure.copy():
-                if ant.body == best[0].body and ant.appears > best[0].appears:
-                    try:
-                        for j in best:
-                            notsure.remove(j)
-                    except ValueError as e:
-                        pass
-                    best = AntList([ant])
-                elif ant.body == best[0].body and ant.appears == best[0].appears:
-                    best.append(ant)
-                elif ant.body == best[0].body:
-                    notsure.remove(ant)
 
-            if len(best) > 1:
-                for j in best.copy():
-                    if anthill.ishead(j.head):
-                        best.remove(j)
-            if len(best) == 1 and (not anthill.ishead(best[0].head)) and best != AntList([Ant(bodyId, '0', 0)]):
-                try:
-                    for j in best:
-                        notsure.remove(j)
-                    anthill += best
-                except ValueError as e:
-                    pass
-
-    print('The number of ants detected by script', len(anthill))
+def correct(jsfile, anthill: AntList, feature2num: Dict[str, int], roifile: list = []):
+    """
+    Warns about the flying heads and cuts the heads going beyond the borders of their bodies clipped by the ROIs.
 
+    Args:
+        jsfile (list): list of the frames or LbxStore, corrected in place
+        anthill (AntList): assigned bodies and heads
+        feature2num (dict): numbers of the featureIds returned by scan_labels
+        roifile (list): ROIs (see RoiIndex)
+    """
+    index = feature_index(jsfile)
+    rois = RoiIndex(roifile)
     for ant in anthill:
         bodyId, headId = ant.body, ant.head
-        for frame in jsfile:
-            for obj in frame['objects']:
-                if obj['featureId'] == bodyId:
-                    bLeft, bRight = obj['bbox']['left'], obj['bbox']['left'] + obj['bbox']['width']
-                    bTop, bBottom = obj['bbox']['top'], obj['bbox']['top'] + obj['bbox']['height']
-                    for roi in roifile:
-                        if roi.interval[0] <= frame['frameNumber'] <= roi.interval[1]:
-                            x1, y1, w, h = roi.ROI[0], roi.ROI[1]
-                            bLeft, bRight = max(bLeft, x1), min(bRight, x1 + w)
-                            bTop, bBottom = max(bTop, y1), min(bBottom, y1 + h)
-
-            for obj in frame['objects']:
-                if obj['featureId'] == headId:
-                    hLeft, hRight = obj['bbox']['left'], obj['bbox']['left'] + obj['bbox']['width']
-                    hTop, hBottom = obj['bbox']['top'], obj['bbox']['top'] + obj['bbox']['height']
-
-                    if not bTop < (hBottom + hTop) / 2 < bBottom or not bLeft < (hLeft + hRight) / 2 < bRight:
-                        print(
-                            'WARNING: flying head featureId {}, body featureId {} probably the number {}, frame {}'.format(
-                                headId,
-                                bodyId,
-                                feature2num[headId],
-                                frame['frameNumber']))
-                    elif hLeft < bLeft or hTop < bTop or hRight > bRight or hBottom > bBottom:
-                        # print('Annotations for body={}, head={} where changed on frame {}'.format(feature2num[bodyId],
-                        #                                                                           feature2num[headId],
-                        #                                                                           frame['frameNumber']))
-                        obj['bbox']['left'] = max(hLeft, bLeft)
-                        obj['bbox']['width'] = min(hRight, bRight) - hLeft
-                        obj['bbox']['top'] = max(hTop, bTop)
-                        obj['bbox']['height'] = min(hBottom, bBottom) - hTop
-                    for roi in roifile:
-                        if roi.interval[0] <= frame['frameNumber'] <= roi.interval[1]:
-                            x1, y1, w, h = roi.ROI[0], roi.ROI[1]
-                            hLeft, hRight = max(hLeft, x1), min(hRight, x1 + w)
-                            hTop, hBottom = max(hTop, y1), min(hBottom, y1 + h)
-    with open("new.json", 'w') as file:
-        dump(jsfile, file)
+        body = None
+        # occurrences in the order of the frames, the body goes before the head within the frame
+        for num, kind, pos in sorted([(num, 0, pos) for num, pos in index.get(bodyId, [])] +
+                                     [(num, 1, pos) for num, pos in index.get(headId, [])]):
+            frame = jsfile[num]
+            obj = frame['objects'][pos]
+            if not kind:
+                bLeft, bRight = obj['bbox']['left'], obj['bbox']['left'] + obj['bbox']['width']
+                bTop, bBottom = obj['bbox']['top'], obj['bbox']['top'] + obj['bbox']['height']
+                for x1, y1, w, h in rois.active(frame['frameNumber']):
+                    bLeft, bRight = max(bLeft, x1), min(bRight, x1 + w)
+                    bTop, bBottom = max(bTop, y1), min(bBottom, y1 + h)
+                body = bLeft, bTop, bRight, bBottom
+                continue
+            if body is None:
+                # the body has not appeared yet
+                continue
+            bLeft, bTop, bRight, bBottom = body
+            hLeft, hRight = obj['bbox']['left'], obj['bbox']['left'] + obj['bbox']['width']
+            hTop, hBottom = obj['bbox']['top'], obj['bbox']['top'] + obj['bbox']['height']
+
+            if not bTop < (hBottom + hTop) / 2 < bBottom or not bLeft < (hLeft + hRight) / 2 < bRight:
+                print(
+                    'WARNING: flying head featureId {}, body featureId {} probably the number {}, frame {}'.format(
+                        headId,
+                        bodyId,
+                        feature2num[headId],
+                        frame['frameNumber']))
+            elif hLeft < bLeft or hTop < bTop or hRight > bRight or hBottom > bBottom:
+                # print('Annotations for body={}, head={} where changed on frame {}'.format(feature2num[bodyId],
+                #                                                                           feature2num[headId],
+                #                                                                           frame['frameNumber']))
+                obj['bbox']['left'] = max(hLeft, bLeft)
+                obj['bbox']['width'] = min(hRight, bRight) - hLeft
+                obj['bbox']['top'] = max(hTop, bTop)
+                obj['bbox']['height'] = min(hBottom, bBottom) - hTop
+
+
+def valid(jsfile, roifile=[], min_support=1, outpath='new.json'):
+    annot = shorten_file(jsfile)
+    bodies, heads, feature2num = scan_labels(jsfile)
+
+    # featureIds are sorted to make the assignment independent of the order of the sets
+    notsure = associate(annot, sorted(bodies), sorted(heads))
+    anthill = assign_heads(notsure, min_support)
+    anthill.feature2num = feature2num
+
+    print('The number of ants detected by script', len(anthill))
+
+    correct(jsfile, anthill, feature2num, roifile)
+    if outpath:
+        dump_frames(jsfile, outpath)
     return anthill
 
 
+def count_frames(path: str):
+    """
+    Returns:
+        number of frames of the store, None if the json file is parsed bypassing the cache
+        and can not be split into the shards
+    """
+    return len(LbxStore.open(path)) if is_store(path) else None
+
+
+def load_shard(path: str, first: int, last: int) -> list:
+    return load_annotations(path, cache=False)[first:last]
+
+
+def shard_labels(path: str, first: int, last: int) -> tuple:
+    """
+    Returns scan_labels of the frames first..last - 1 of the store or file, executed by a worker.
+    """
+    return scan_labels(load_shard(path, first, last))
+
+
+def shard_pairs(path: str, first: int, last: int, bodies: list, heads: list) -> AntList:
+    """
+    Returns the body-head pairs of the frames first..last - 1 of the store or file (see associate),
+    executed by a worker.
+    """
+    return associate(shorten_file(load_shard(path, first, last)), bodies, heads)
+
+
+def validate_file(path: str, notsure: AntList, feature2num: Dict[str, int], roifile: list, min_support: int,
+                  outdir: str, name: str = None) -> AntList:
+    """
+    Assigns the heads and corrects the store or file, executed by a worker. The report is written
+    to <outdir>/<name>.txt and the corrected annotations to <outdir>/<name>.json, name is taken from path by default.
+    """
+    name = name or os.path.splitext(os.path.basename(path.rstrip(os.sep)))[0]
+    with open(os.path.join(outdir, name + '.txt'), 'w') as file, redirect_stdout(file):
+        anthill = assign_heads(notsure, min_support)
+        anthill.feature2num = feature2num
+        print('The number of ants detected by script', len(anthill))
+        jsfile = load_annotations(path, cache=False)
+        correct(jsfile, anthill, feature2num, roifile)
+        dump_frames(jsfile, os.path.join(outdir, name + '.json'))
+        anthill.print()
+    return anthill
+
+
+def valid_batch(paths: list, outdir: str, roifile: list = [], min_support: int = 1, jobs: int = None,
+                shard_size: int = SHARD_SIZE, cache: bool = True) -> Dict[str, AntList]:
+    """
+    Validates many files by a process pool. The frames of the files are split into the shards,
+    the labels and the body-head pairs of the shards are merged per file before the assignment,
+    so the result is the same as the one of valid. The files are corrected in parallel.
+    The json files are cached by the calling process, the workers read the cached stores.
+
+    Args:
+        paths (list): paths to the annotation files or stores
+        outdir (str): output directory of the reports and corrected annotations
+        roifile (list): ROIs (see RoiIndex)
+        min_support (int): minimal number of frames where the head should lie inside the body
+        jobs (int): number of the worker processes, the number of CPUs by default
+        shard_size (int): number of frames processed by a worker, the files parsed bypassing the cache
+            are not split
+        cache (bool): False if the json files should be parsed bypassing the cache of the parsed annotations
+    Returns:
+        {<path>: <anthill>}
+    """
+    os.makedirs(outdir, exist_ok=True)
+    sources = {path: store_path(path, cache) for path in paths}
+    shards = []
+    for path in paths:
+        total = count_frames(sources[path])
+        shards += [(path, None, None)] if total is None else \
+            [(path, first, first + shard_size) for first in range(0, total, shard_size)]
+    stores = [sources[path] for path, _, _ in shards]
+    firsts, lasts = [first for _, first, _ in shards], [last for _, _, last in shards]
+
+    with ProcessPoolExecutor(jobs) as pool:
+        labels = {path: (set(), set(), {}) for path in paths}
+        for (path, _, _), (bodies, heads, feature2num) in zip(shards, pool.map(shard_labels, stores, firsts, lasts)):
+            labels[path][0].update(bodies)
+            labels[path][1].update(heads)
+            for featureId, num in feature2num.items():
+                labels[path][2][featureId] = max(num, labels[path][2].get(featureId, 0))
+
+        # featureIds are sorted to make the assignment independent of the order of the sets
+        ids = {path: (sorted(bodies), sorted(heads)) for path, (bodies, heads, _) in labels.items()}
+        bodies = [ids[path][0] for path, _, _ in shards]
+        heads = [ids[path][1] for path, _, _ in shards]
+        counts = {path: {} for path in paths}
+        for (path, _, _), ants in zip(shards, pool.map(shard_pairs, stores, firsts, lasts, bodies, heads)):
+            for ant in ants:
+                counts[path][ant.body, ant.head] = counts[path].get((ant.body, ant.head), 0) + ant.appears
+        notsure = [AntList(Ant(body, head, num) for (body, head), num in counts[path].items()) for path in paths]
+
+        names = [os.path.splitext(os.path.basename(path.rstrip(os.sep)))[0] for path in paths]
+        anthills = pool.map(validate_file, [sources[path] for path in paths], notsure,
+                            [labels[path][2] for path in paths], repeat(roifile), repeat(min_support), repeat(outdir),
+                            names)
+        return dict(zip(paths, anthills))
+
+
 if __name__ == '__main__':
     parser = ArgumentParser(description='Document Taxonomy Builder.',
                             formatter_class=ArgumentDefaultsHelpFormatter,
                             conflict_handler='resolve')
-    parser.add_argument('-a', '--annotations', type=str, help='Path to an annotation file')
+    parser.add_argument('-a', '--annotations', type=str, nargs='+', help='Paths to the annotation files or stores',
+                        required=True)
     parser.add_argument('-r', '--roi', type=str, help='Path to the ROI file')
+    parser.add_argument('-o', '--output', type=str, default='new.json',
+                        help='Path to the corrected annotations written frame by frame')
+    parser.add_argument('--min-support', type=int, default=1,
+                        help='Minimal number of frames where the head lies inside the body to assign them')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='Number of processes validating the shards of the files in parallel')
+    parser.add_argument('--shard-size', type=int, default=SHARD_SIZE,
+                        help='Number of frames processed by one process in the batch mode')
+    parser.add_argument('--outp-dir', type=str, default=os.path.join(os.getcwd(), 'validated'),
+                        help='Output directory of the reports and corrected annotations in the batch mode '
+                             '(several files or --jobs > 1)')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='parse the json files bypassing the cache of the parsed annotations')
+    parser.add_argument('--clear-cache', action='store_true', help='clear the cache of the parsed annotations')
     opt = parser.parse_args() #"-a E:\\work\\EuresysCapturing_IR_100_2021-08-24_17.json".split()
-    if opt.annotations:
-        with open(opt.annotations, 'r') as file:
-            jsfile = load(file)
+    if opt.clear_cache:
+        clear_cache()
     if opt.roi:
         with open(opt.roi, 'r') as file:
             roifile = load(file)
     else:
         roifile = []
-    valid(jsfile, roifile).print()
-    # print(feature2num)
+    if len(opt.annotations) > 1 or opt.jobs > 1:
+        results = valid_batch(opt.annotations, opt.outp_dir, roifile, opt.min_support, opt.jobs, opt.shard_size,
+                              opt.cache)
+        for path, anthill in results.items():
+            print('{}: {} ants, the report and corrected annotations are saved in {}'.format(path, len(anthill),
+                                                                                         opt.outp_dir))
+    else:
+        # the store keeps the corrected frames, which are streamed to the output with the rest
+        jsfile = load_annotations(opt.annotations[0], opt.cache)
+        valid(jsfile, roifile, opt.min_support, opt.output).print()
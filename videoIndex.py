@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+:Description: Seek index of the videos. The video is scanned once and the sidecar <video>.seek.npz keeps
+the timestamp of each frame, the keyframes and the verified number of frames, so the GUI tools land on the exact
+frame by decoding forward from the closest keyframe.
+
+:Authors: (c) Valentyna Pryhodiuk <vpryhodiuk@lumais.com>
+:Date: 2026-10-17
+"""
+import os
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from array import array
+from typing import Dict
+
+import cv2
+import numpy as np
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.seek.npz'
+# distance between the seek points if the backend does not report the keyframes
+CHECKPOINT = 250
+# tolerance of the frame timestamps in ms
+PTS_TOLERANCE = 0.5
+# number of the keyframes tried before the seek falls back to the beginning of the video
+SEEK_ATTEMPTS = 3
+# number of the reported keyframes verified by seeking to them after the scan
+VERIFY_KEYFRAMES = 8
+# number of the scanned frames between the progress updates
+PROGRESS_STEP = 1000
+
+
+def index_path(video: str) -> str:
+    return video + INDEX_SUFFIX
+
+
+def verify_keyframes(video: str, pts: np.ndarray, keyframes: np.ndarray) -> bool:
+    """
+    Seeks to a sample of the keyframes and compares the timestamps of the landed frames with the ones
+    of the linear decoding.
+
+    Returns:
+        True if the decoder lands on all the sampled keyframes
+    """
+    sample = keyframes[keyframes > 0]
+    if not len(sample):
+        return True
+    sample = sample[np.linspace(0, len(sample) - 1, min(VERIFY_KEYFRAMES, len(sample))).astype(int)]
+    vid = cv2.VideoCapture(video)
+    try:
+        for key in sample.tolist():
+            vid.set(cv2.CAP_PROP_POS_FRAMES, key)
+            if not vid.grab() or abs(vid.get(cv2.CAP_PROP_POS_MSEC) - pts[key]) > PTS_TOLERANCE:
+                return False
+    finally:
+        vid.release()
+    return True
+
+
+def build_index(video: str, save: bool = True, verbose: bool = True) -> Dict[str, np.ndarray]:
+    """
+    Decodes all the packets of the video once to index its frames, which takes about the time of playing it back
+    at the decoding speed, so the progress is printed.
+
+    The keyframes are taken from CAP_PROP_LRF_HAS_KEY_FRAME, which OpenCV documents only for the raw packet mode.
+    If the timestamps identify the frames, a sample of the keyframes is verified by seeking to them and the evenly
+    spaced checkpoints are used instead if any of them fails. Otherwise the keyframes are not verified, which is
+    safe only for the backends reporting them correctly.
+
+    Args:
+        video (str): path to the video
+        save (bool): False if the sidecar should not be written
+        verbose (bool): False if the progress should not be printed
+    Returns:
+        {"pts": timestamp of each frame in ms, "keyframes": sorted positions of the seek points,
+         "count": verified number of frames, "exact": True if the timestamps identify the frames,
+         "size", "mtime_ns": of the indexed video, "version"}
+    """
+    vid = cv2.VideoCapture(video)
+    if not vid.isOpened():
+        raise IOError('cannot open the video ' + video)
+    total = int(vid.get(cv2.CAP_PROP_FRAME_COUNT))
+    if verbose:
+        print('Indexing {}{}'.format(video, ' once, the index is saved to ' + index_path(video) if save else ''))
+    pts, keyframes = array('d'), array('q')
+    while vid.grab():
+        if vid.get(cv2.CAP_PROP_LRF_HAS_KEY_FRAME):
+            keyframes.append(len(pts))
+        pts.append(vid.get(cv2.CAP_PROP_POS_MSEC))
+        if verbose and len(pts) % PROGRESS_STEP == 0:
+            print('\r{} frames{}'.format(len(pts), ' of ~{}'.format(total) if total > 0 else ''), end='', flush=True)
+    vid.release()
+    if verbose:
+        print('\r{} frames indexed'.format(len(pts)))
+
+    pts = np.frombuffer(pts, dtype=np.float64)
+    keyframes = np.frombuffer(keyframes, dtype=np.int64)
+    exact = len(pts) < 2 or bool(np.all(np.diff(pts) > 2 * PTS_TOLERANCE))
+    if len(keyframes) >= 2 and exact and not verify_keyframes(video, pts, keyframes):
+        if verbose:
+            print('The keyframes reported by the backend are not confirmed by seeking, the checkpoints are used')
+        keyframes = keyframes[:0]
+    if len(keyframes) < 2:
+        # the backend has not reported the keyframes, the seeks of OpenCV itself are verified on the checkpoints
+        keyframes = np.arange(0, max(1, len(pts)), CHECKPOINT, dtype=np.int64)
+    elif keyframes[0] != 0:
+        keyframes = np.concatenate([[0], keyframes])
+    stat = os.stat(video)
+    index = {'pts': pts, 'keyframes': keyframes, 'count': np.int64(len(pts)), 'exact': np.bool_(exact),
+             'size': np.int64(stat.st_size), 'mtime_ns': np.int64(stat.st_mtime_ns),
+             'version': np.int64(INDEX_VERSION)}
+    if save:
+        path = index_path(video)
+        try:
+            # the sidecar is replaced atomically
+            with open(path + '.part', 'wb') as file:
+                np.savez(file, **index)
+            os.replace(path + '.part', path)
+        except OSError:
+            pass
+    return index
+
+
+def load_index(video: str, build: bool = True, verbose: bool = True) -> Dict[str, np.ndarray]:
+    """
+    Loads the sidecar of the video if it is up to date, indexing the video otherwise (see build_index).
+
+    Args:
+        video (str): path to the video
+        build (bool): False if None should be returned instead of indexing the video
+        verbose (bool): False if the progress of the indexing should not be printed
+    Returns:
+        the index (see build_index) or None
+    """
+    path = index_path(video)
+    try:
+        stat = os.stat(video)
+        with np.load(path) as data:
+            index = {key: data[key] for key in data.files}
+        if (int(index['version']), int(index['size']), int(index['mtime_ns'])) == \
+                (INDEX_VERSION, stat.st_size, stat.st_mtime_ns):
+            return index
+    except (OSError, ValueError, KeyError):
+        pass
+    return build_index(video, verbose=verbose) if build else None
+
+
+class VideoSeeker:
+    """
+    Reads the exact frames of the video by its index, the replacement of cv2.VideoCapture for the random access.
+    The frame of the same group of pictures ahead is reached by decoding forward, otherwise the decoder is set
+    to the closest keyframe before the frame, the landing is verified by the timestamp, and the rest is decoded.
+
+    Args:
+        video (str): path to the video
+        index (dict): index of the video, loaded or built by default
+    """
+
+    def __init__(self, video: str, index: Dict[str, np.ndarray] = None):
+        self.vid = cv2.VideoCapture(video)
+        self.index = index if index is not None else load_index(video)
+        self.pts = self.index['pts']
+        self.keyframes = self.index['keyframes']
+        self.count = int(self.index['count'])
+        self.last = -1  # position of the last grabbed frame
+        self.seeks = 0
+
+    def get(self, prop: int) -> float:
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return self.count
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return self.last + 1
+        return self.vid.get(prop)
+
+    def set(self, prop: int, value: float) -> bool:
+        if prop != cv2.CAP_PROP_POS_FRAMES:
+            return self.vid.set(prop, value)
+        # the next grab decodes the frame of the position
+        self.grab(int(value) - 1) if int(value) > 0 else self._seek(0, rewind=True)
+        return True
+
+    def _locate(self) -> int:
+        # position of the grabbed frame by its timestamp, -1 if it is unknown
+        if not self.index['exact']:
+            return -1
+        msec = self.vid.get(cv2.CAP_PROP_POS_MSEC)
+        pos = int(np.searchsorted(self.pts, msec - PTS_TOLERANCE))
+        return pos if pos < len(self.pts) and abs(self.pts[pos] - msec) <= PTS_TOLERANCE else -1
+
+    def _seek(self, pos: int, rewind: bool = False):
+        self.seeks += 1
+        first = int(np.searchsorted(self.keyframes, pos, 'right')) - 1
+        for key in reversed(self.keyframes[max(first - SEEK_ATTEMPTS + 1, 0):first + 1].tolist()):
+            if key == 0 or rewind:
+                break
+            self.vid.set(cv2.CAP_PROP_POS_FRAMES, key)
+            if not self.vid.grab():
+                continue
+            landed = self._locate() if self.index['exact'] else key
+            if 0 <= landed <= pos:
+                self.last = landed
+                return
+        self.vid.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        self.last = -1
+
+    def grab(self, pos: int = None) -> bool:
+        """
+        Grabs the frame of the position, the next one by default.
+        """
+        pos = self.last + 1 if pos is None else pos
+        if not 0 <= pos < self.count:
+            return False
+        # decoding forward is not longer than from the keyframe of the frame
+        key = self.keyframes[np.searchsorted(self.keyframes, pos, 'right') - 1]
+        if not self.last < pos or key > self.last + 1:
+            self._seek(pos)
+        while self.last < pos:
+            if not self.vid.grab():
+                return False
+            self.last += 1
+        return True
+
+    def retrieve(self) -> tuple:
+        return self.vid.retrieve()
+
+    def read(self, pos: int = None) -> tuple:
+        """
+        Returns:
+            ok (bool), the frame of the position (the next one by default)
+        """
+        if pos != self.last and not self.grab(pos):
+            return False, None
+        return self.vid.retrieve()
+
+    def release(self):
+        self.vid.release()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Document Taxonomy Builder.',
+                            formatter_class=ArgumentDefaultsHelpFormatter,
+                            conflict_handler='resolve')
+    parser.add_argument('-v', '--video', nargs='+', help='Videos to index', required=True)
+    parser.add_argument('--force', action='store_true', help='Index the videos even if their sidecars are up to date')
+    args = parser.parse_args()
+
+    for video in args.video:
+        index = build_index(video) if args.force else load_index(video)
+        gops = np.diff(np.append(index['keyframes'], index['count']))
+        print('{}: {} frames ({} in the header), {} keyframes, the longest group of pictures is {} frames{}'.format(
+            video, int(index['count']), int(cv2.VideoCapture(video).get(cv2.CAP_PROP_FRAME_COUNT)),
+            len(index['keyframes']), int(gops.max()) if len(gops) else 0,
+            '' if index['exact'] else ', the timestamps do not identify the frames'))
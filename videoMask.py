@@ -6,17 +6,34 @@
 :Authors: (c) Valentyna Pryhodiuk <vpryhodiuk@lumais.com>
 :Date: 2020-11-10
 """
+import json
+import os
 import cv2
 import numpy as np
 import matplotlib._color_data as mcd
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
 from re import split
 from PIL import Image, ImageDraw
 from numpy.random import randint
 from random import choice, seed
 from datetime import datetime
+from queue import Queue, Empty, Full
+from threading import Thread, Event
+from time import perf_counter
+from shutil import rmtree
+from tempfile import mkdtemp
 
+from videoIndex import VideoSeeker, load_index
+
+# lossless codec of the temporary segments to avoid double compression of the chunks
+SEGMENT_FOURCC = 'FFV1'
+# maximal number of frames of a segment, the disk space of the segments in flight is bounded by workers segments
+SEGMENT_FRAMES = 500
+# cropped frames are padded to the multiple of the codec block size
+PX_BLOCK = 8
 
 
 class Roi:
@@ -49,7 +66,485 @@ class Roi:
         self.end = self.end if "!" not in roi else params[-1]
 
 
-def roi_processing(vidpath: str, rois: str, filename: str, rand: bool = False, static: bool = True, color: str = "black"):
+def roi_spans(roi_list: list, total: int) -> list:
+    """
+    Sweeps the ROI schedule into the spans of frames sharing the same set of active ROIs.
+
+    Args:
+        roi_list (list): list of Roi objects with numeric start and end
+        total (int): number of frames in a video
+    Returns:
+        [(start, end, active)] - inclusive frame interval and a tuple of indices of the active ROIs
+    """
+    bounds = {1, total + 1}
+    for roi in roi_list:
+        bounds.update((roi.start, roi.end + 1))
+    bounds = sorted(b for b in bounds if 1 <= b <= total + 1)
+
+    spans = []
+    for start, stop in zip(bounds, bounds[1:]):
+        active = tuple(i for i, roi in enumerate(roi_list) if roi.start <= start <= roi.end)
+        if spans and spans[-1][2] == active:
+            spans[-1] = (spans[-1][0], stop - 1, active)
+        else:
+            spans.append((start, stop - 1, active))
+    return spans
+
+
+def build_mask(rois: list, width: int, height: int) -> np.ndarray:
+    """
+    Draws the given ROIs into a single mask.
+
+    Args:
+        rois (list): list of Roi objects to draw
+        width (int): width of the frame
+        height (int): height of the frame
+    Returns:
+        boolean array of shape (height, width), which is True outside all the ROIs
+    """
+    mask = Image.new("L", (width, height), 0)
+    draw = ImageDraw.Draw(mask)
+    for roi in rois:
+        x1, y1, w, h = roi.xywh
+
+        if x1 > width or y1 > height:
+            raise UnboundLocalError("Process interrupted \nInvalidArgument: wrong coordinates of the roi. Please, check the frame size.")
+
+        # change coordinates of the ROI's Right Bottom corner if it is out of boundaries
+        x2, y2 = min(w + x1, width), min(h + y1, height)
+
+        if roi.shape == "ellipse":
+            draw.ellipse((x1, y1, x2, y2), fill=255)
+        else:
+            draw.rectangle((x1, y1, x2, y2), fill=255)
+    return np.asarray(mask) == 0
+
+
+def crop_box(roi_list: list, width: int, height: int, block: int = PX_BLOCK) -> tuple:
+    """
+    Evaluates the union bounding box of all the ROIs padded to the codec block size.
+
+    Args:
+        roi_list (list): list of Roi objects
+        width (int): width of the frame
+        height (int): height of the frame
+        block (int): size of the codec block in pixels
+    Returns:
+        (left, top, width, height) of the crop within the frame
+    """
+    left = min(roi.xywh[0] for roi in roi_list)
+    top = min(roi.xywh[1] for roi in roi_list)
+    # the right bottom corner of the ROI is drawn inclusively
+    right = min(max(roi.xywh[0] + roi.xywh[2] for roi in roi_list) + 1, width)
+    bottom = min(max(roi.xywh[1] + roi.xywh[3] for roi in roi_list) + 1, height)
+
+    box = []
+    for start, stop, size in ((left, right, width), (top, bottom, height)):
+        if start >= size:
+            raise UnboundLocalError("Process interrupted \nInvalidArgument: wrong coordinates of the roi. Please, check the frame size.")
+        # Adjust to X px padding, shifting the box back if it goes beyond the frame
+        length = min(stop - start + (start - stop) % block, size)
+        box.append((min(start, size - length), length))
+    (left, w), (top, h) = box
+    return left, top, w, h
+
+
+def save_crop(filename: str, box: tuple, width: int, height: int) -> str:
+    """
+    Saves the crop offset next to the cropped video to map the annotations back to the original frame.
+
+    Args:
+        filename (str): name of the cropped video
+        box (tuple): (left, top, width, height) of the crop
+        width (int): width of the original frame
+        height (int): height of the original frame
+    Returns:
+        name of the sidecar file
+    """
+    sidecar = os.path.splitext(filename)[0] + '_crop.json'
+    with open(sidecar, 'w') as file:
+        json.dump({'left': box[0], 'top': box[1], 'width': box[2], 'height': box[3],
+                   'frameWidth': width, 'frameHeight': height}, file)
+    return sidecar
+
+
+class NoisePool:
+    """
+    Pre-rendered noise textures cycled by a seeded schedule to change the random background
+    on every frame without generating the noise per frame.
+
+    Fields:
+        textures (np.ndarray) - (size, height, width, 3) noise textures
+        schedule (np.ndarray) - index of the texture by the frame number modulo its length
+        path (str) - .npy file the textures are persisted to or None
+    """
+
+    def __init__(self, width: int, height: int, size: int = 16, randseed: int = 0, path: str = None):
+        rng = np.random.RandomState(randseed)
+        # consecutive frames never get the same texture
+        self.schedule = np.cumsum(rng.randint(1, max(size, 2), size * 64)) % size
+        self.path = None
+        self.textures = None
+        if path and os.path.exists(path):
+            textures = np.load(path, mmap_mode='r')
+            if textures.shape == (size, height, width, 3):
+                self.textures, self.path = textures, path
+            else:
+                print('WARNING: noise pool {} of shape {} does not fit {} textures of {}x{}, it is regenerated'.format(
+                    path, textures.shape, size, width, height))
+                path = None
+        if self.textures is None:
+            self.textures = rng.randint(0, 256, (size, height, width, 3), dtype=np.uint8)
+            if path:
+                self.save(path)
+
+    def save(self, path: str):
+        np.save(path, self.textures)
+        self.path = path
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        return self.textures[self.schedule[i % len(self.schedule)]]
+
+
+class FrameMasker:
+    """
+    Applies the ROI schedule to the frames of a video.
+
+    Masks are built once per span of frames with the same set of active ROIs and cached,
+    the background is composited in place on the BGR frame.
+
+    Fields:
+        spans (list) - (start, end, active) spans produced by roi_spans
+        masks (dict) - cache of the background masks by the tuple of active ROIs
+        box (tuple) - (left, top, width, height) of the crop or None to keep the whole frame
+        width, height (int) - size of the output frames
+        pool (NoisePool) - textures of the dynamic random background or None to generate it per frame
+    """
+
+    def __init__(self, roi_list: list, total: int, width: int, height: int,
+                 rand: bool = False, static: bool = True, color: str = None, box: tuple = None,
+                 pool: NoisePool = None):
+        self.roi_list = roi_list
+        self.frame_size = (width, height)
+        self.box = box
+        if box is not None:
+            width, height = box[2:]
+        self.width, self.height = width, height
+        self.pool = pool
+        self.rand = rand
+        self.static = static
+        self.spans = roi_spans(roi_list, total)
+        self.starts = [span[0] for span in self.spans]
+        self.masks = {}
+
+        # get hex code for a background color by name
+        hcode = choice(list(mcd.CSS4_COLORS.values())) if not color else mcd.CSS4_COLORS[color]
+        self.bgcolor = self.hex2bgr(hcode)
+        self.bg = None
+        if static and rand:
+            self.bg = randint(0, 256, (height, width, 3)).astype(np.uint8)
+
+    @staticmethod
+    def hex2bgr(hcode: str) -> tuple:
+        h = hcode.lstrip('#')
+        return tuple(int(h[i:i + 2], 16) for i in (4, 2, 0))
+
+    def mask(self, i: int):
+        """
+        Args:
+            i (int): frame number starting from 1
+        Returns:
+            cached background mask for the frame or None if no ROI is active on it
+        """
+        span = bisect_right(self.starts, i) - 1
+        if span < 0 or i > self.spans[span][1]:
+            return None
+        active = self.spans[span][2]
+        if not active:
+            return None
+        if active not in self.masks:
+            bgmask = build_mask([self.roi_list[j] for j in active], *self.frame_size)
+            if self.box is not None:
+                x, y, w, h = self.box
+                bgmask = np.ascontiguousarray(bgmask[y:y + h, x:x + w])
+            self.masks[active] = bgmask
+        return self.masks[active]
+
+    def apply(self, i: int, frame: np.ndarray, copy: bool = False) -> np.ndarray:
+        """
+        Fills the background of the frame outside the active ROIs in place.
+
+        Args:
+            i (int): frame number starting from 1
+            frame (np.ndarray): BGR frame
+            copy (bool): True if the given frame should be kept intact
+        Returns:
+            the same frame or its masked copy if copy is True or the frame is cropped
+        """
+        bgmask = self.mask(i)
+        if self.box is not None:
+            x, y, w, h = self.box
+            frame = frame[y:y + h, x:x + w].copy()
+        elif copy and bgmask is not None:
+            frame = frame.copy()
+        if bgmask is None:
+            return frame
+        if self.rand:
+            if self.static:
+                bg = self.bg
+            elif self.pool is not None:
+                bg = self.pool[i]
+            else:
+                bg = randint(0, 256, (self.height, self.width, 3)).astype(np.uint8)
+            np.copyto(frame, bg, where=bgmask[:, :, None])
+        else:
+            color = self.bgcolor if self.static else self.hex2bgr(choice(list(mcd.CSS4_COLORS.values())))
+            frame[bgmask] = color
+        return frame
+
+
+def load_rois(rois: list, total: int) -> list:
+    """
+    Args:
+        rois (list): list of strings LEFT,TOP,WIDTH,HEIGHT [;SHAPE=rect][^FRAME_START=0][!FRAME_FINISH=LAST_FRAME]]
+        total (int): number of frames in a video
+    Returns:
+        list of Roi objects with the numeric end
+    """
+    roi_list = []
+    for roi in rois:
+        roi = Roi(roi)
+        roi.end = total if roi.end == "$" else roi.end
+        roi_list.append(roi)
+    return roi_list
+
+
+def mask_chunk(vidpath: str, roi_list: list, total: int, segpath: str, first: int, last: int,
+               randseed: int, chunk: int, rand: bool, static: bool, color: str, box: tuple = None,
+               pool_size: int = 0, noise_pool: str = None, index: dict = None) -> tuple:
+    """
+    Masks the frames first..last of a video into a temporary lossless segment.
+    Executed in a worker process. The chunk is sought by the index of the video (see videoIndex.VideoSeeker),
+    so it starts on the exact frame even if the seek of the decoder lands elsewhere.
+
+    Args:
+        segpath (str): path to the segment to be written
+        first (int): first frame of the chunk starting from 1
+        last (int): last frame of the chunk
+        randseed (int): seed shared by all the chunks
+        chunk (int): index of the chunk to derive its own seed
+        box (tuple): (left, top, width, height) of the crop or None
+        pool_size (int): number of the noise textures, 0 to generate the noise per frame
+        noise_pool (str): .npy file of the noise textures
+        index (dict): index of the video, loaded or built by default (see videoIndex.load_index)
+    Returns:
+        segpath, number of written frames
+    """
+    vid = VideoSeeker(vidpath, index)
+    vid.set(cv2.CAP_PROP_POS_FRAMES, first - 1)
+    width, height = int(vid.get(cv2.CAP_PROP_FRAME_WIDTH)), int(vid.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+    # the static background is the same for all chunks, dynamic one is seeded per chunk
+    seed(randseed)
+    np.random.seed(randseed)
+    pool = None
+    if rand and not static and pool_size:
+        pool = NoisePool(*(box[2:] if box else (width, height)), pool_size, randseed, noise_pool)
+    masker = FrameMasker(roi_list, total, width, height, rand, static, color, box, pool)
+    writer = cv2.VideoWriter(segpath, cv2.VideoWriter_fourcc(*SEGMENT_FOURCC),
+                             vid.get(cv2.CAP_PROP_FPS), (masker.width, masker.height))
+    if not writer.isOpened():
+        vid.release()
+        raise IOError('cannot open the {} writer of the segment {}'.format(SEGMENT_FOURCC, segpath))
+    seed(randseed + chunk + 1)
+    np.random.seed(randseed + chunk + 1)
+
+    written = 0
+    for i in range(first, last + 1):
+        ok, frame = vid.read()
+        if not ok:
+            break
+        writer.write(masker.apply(i, frame))
+        written += 1
+    writer.release()
+    vid.release()
+    return segpath, written
+
+
+class Stage:
+    """
+    Counts the frames passed through a pipeline stage and the time spent on them.
+
+    Fields:
+        name (str) - name of the stage
+        frames (int) - number of processed frames
+        busy (float) - time in seconds spent on the processing, waiting on queues excluded
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.frames = 0
+        self.busy = 0.
+
+    def tick(self, start: float):
+        self.frames += 1
+        self.busy += perf_counter() - start
+
+    def __str__(self):
+        fps = self.frames / self.busy if self.busy else 0.
+        return '{}: {} frames, {:.1f} fps'.format(self.name, self.frames, fps)
+
+
+def read_frames(vid: cv2.VideoCapture, frame: np.ndarray, total: int):
+    """
+    Yields (number, frame) starting from the already decoded first frame.
+    """
+    for i in range(1, total + 1):
+        if frame is None:
+            break
+        yield i, frame
+        _, frame = vid.read()
+
+
+def pipeline(frames, process, write, depth: int = 8) -> list:
+    """
+    Runs decoding, processing and encoding of the frames concurrently. Decoding and encoding are
+    executed in their own threads (OpenCV releases the GIL there), bounded queues between
+    the stages cap the memory.
+
+    Args:
+        frames (iterator): yields (number, frame)
+        process (callable): process(number, frame) -> processed frame, executed in the calling thread
+        write (callable): write(processed frame)
+        depth (int): capacity of each queue
+    Returns:
+        [decode, process, encode] Stage counters
+    """
+    decoded, processed = Queue(max(depth, 1)), Queue(max(depth, 1))
+    stop = Event()
+    errors = []
+    stages = [Stage('decode'), Stage('mask'), Stage('encode')]
+
+    def put(queue, item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def get(queue):
+        while not stop.is_set():
+            try:
+                return queue.get(timeout=0.1)
+            except Empty:
+                pass
+        return None
+
+    def decode():
+        try:
+            while True:
+                start = perf_counter()
+                item = next(frames, None)
+                if item is None:
+                    break
+                stages[0].tick(start)
+                if not put(decoded, item):
+                    break
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        put(decoded, None)
+
+    def encode():
+        try:
+            while True:
+                item = get(processed)
+                if item is None:
+                    break
+                start = perf_counter()
+                write(item)
+                stages[2].tick(start)
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+
+    threads = [Thread(target=decode, daemon=True), Thread(target=encode, daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            item = get(decoded)
+            if item is None:
+                break
+            start = perf_counter()
+            item = process(*item)
+            stages[1].tick(start)
+            if not put(processed, item):
+                break
+        put(processed, None)
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+    return stages
+
+
+def mask_chunks(vidpath: str, roi_list: list, total: int, writer: cv2.VideoWriter, workers: int,
+                randseed: int, rand: bool, static: bool, color: str, box: tuple = None, noise: NoisePool = None):
+    """
+    Splits the video into chunks masked by a process pool and stitches the segments in order.
+
+    Args:
+        writer (cv2.VideoWriter): writer of the final video
+        workers (int): number of processes
+        noise (NoisePool): textures of the dynamic random background shared by the workers via a .npy file
+    """
+    step = min(-(-total // workers), SEGMENT_FRAMES)
+    # the video is indexed once, the workers seek their chunks by the index
+    index = load_index(vidpath)
+    chunks = list(enumerate(range(1, total + 1, step)))
+    # the segments are written into TMPDIR if it is set, next to the video otherwise
+    segdir = mkdtemp(prefix='videoMask-', dir=os.environ.get('TMPDIR') or os.path.dirname(os.path.abspath(vidpath)))
+    try:
+        pool_size = 0
+        if noise is not None:
+            pool_size = len(noise.textures)
+            if noise.path is None:
+                noise.save(os.path.join(segdir, 'noise.npy'))
+
+        def submit(chunk, first):
+            return pool.submit(mask_chunk, vidpath, roi_list, total, os.path.join(segdir, '{:04d}.avi'.format(chunk)),
+                               first, min(first + step - 1, total), randseed, chunk, rand, static, color, box,
+                               pool_size, noise.path if noise is not None else None, index)
+
+        with ProcessPoolExecutor(workers) as pool:
+            # at most workers segments are in flight, each one is deleted as soon as it is stitched
+            futures = [submit(*chunk) for chunk in chunks[:workers]]
+            for following in range(workers, len(chunks) + workers):
+                segpath, written = futures.pop(0).result()
+                if following < len(chunks):
+                    futures.append(submit(*chunks[following]))
+                seg = cv2.VideoCapture(segpath)
+                for _ in range(written):
+                    ok, frame = seg.read()
+                    if not ok:
+                        break
+                    writer.write(frame)
+                seg.release()
+                os.remove(segpath)
+    finally:
+        rmtree(segdir, ignore_errors=True)
+
+
+def roi_processing(vidpath: str, rois: str, filename: str, rand: bool = False, static: bool = True, color: str = "black",
+                   workers: int = 1, randseed: int = None, depth: int = 8, crop: bool = False,
+                   pool_size: int = 16, noise_pool: str = None):
     """
 
     Args:
@@ -58,64 +553,137 @@ def roi_processing(vidpath: str, rois: str, filename: str, rand: bool = False, s
         filename (str): name for a new video
         rand (bool): True if background needs to be randomly colored
         color (str): color of a background written in English (red, blue, etc.)
+        workers (int): number of processes masking the chunks of the video
+        randseed (int): seed of the random background, taken from the current time if omitted
+        depth (int): maximal number of frames waiting between the decoding, masking and encoding threads
+        crop (bool): True if only the bounding box of the ROIs should be written
+        pool_size (int): number of pre-rendered textures of the dynamic random background, 0 to generate it per frame
+        noise_pool (str): .npy file to load the textures from or to save them to
     """
     vid = cv2.VideoCapture(vidpath)
     total = int(vid.get(cv2.CAP_PROP_FRAME_COUNT))  # number of frames in a video
     _, frame = vid.read()
     height, width = frame.shape[:2]
     print(width, height)
-    now = datetime.now()
-    seed(now.hour+now.minute+now.second)
-    np.random.seed(now.hour+now.minute+now.second)
+    if randseed is None:
+        now = datetime.now()
+        randseed = now.hour+now.minute+now.second
+    seed(randseed)
+    np.random.seed(randseed)
     print(rand, static)
 
-    roi_list = []
-    for roi in rois:
-        roi = Roi(roi)
-        roi.end = total if roi.end == "$" else roi.end
-        roi_list.append(roi)
+    roi_list = load_rois(rois, total)
+    box = None
+    if crop:
+        box = crop_box(roi_list, width, height)
+        print('Crop offset is saved to', save_crop(filename, box, width, height))
 
     writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*'mp4v'),
-                             vid.get(cv2.CAP_PROP_FPS), (width, height))
+                             vid.get(cv2.CAP_PROP_FPS), box[2:] if box else (width, height))
+    if not writer.isOpened():
+        raise IOError('cannot open the writer of ' + filename)
+    noise = None
+    if rand and not static and pool_size:
+        noise = NoisePool(*(box[2:] if box else (width, height)), pool_size, randseed, noise_pool)
 
-    # get hex code for a background color by name
-    hcode = choice(list(mcd.CSS4_COLORS.values())) if not color else mcd.CSS4_COLORS[color]
-    if static and rand:
-        bg = Image.fromarray(randint(0, 256, (height, width, 3)).astype(np.uint8))
-    else:
-        bg = Image.new('RGB', (width, height), hcode)
-    for i in range(1, total + 1):
-        mask = Image.new("L", (width, height), 0)
-        for roi in roi_list:
-            if roi.start <= i and i <= roi.end:
-                x1, y1, w, h = roi.xywh
-
-                if x1 > width or y1 > height:
-                    raise UnboundLocalError("Process interrupted \nInvalidArgument: wrong coordinates of the roi. Please, check the frame size.")
-
-                # change coordinates of the ROI's Right Bottom corner if it is out of boundaries
-                x2, y2 = min(w + x1, width), min(h + y1, height)
-
-                draw = ImageDraw.Draw(mask)
-                if roi.shape == "ellipse":
-                    draw.ellipse((x1, y1, x2, y2), fill=255)
-                else:
-                    draw.rectangle((x1, y1, x2, y2), fill=255)
-        if mask == Image.new("L", (width, height), 0):
-            masked = frame
-        else:
-            im_frame = Image.fromarray(frame[:, :, ::-1])  # RGB
-            if not static and rand:
-                bg = Image.fromarray(randint(0, 256, (height, width, 3)).astype(np.uint8))
-            elif not static and not rand:
-                hcode = choice(list(mcd.CSS4_COLORS.values()))
-                bg = Image.new('RGB', (width, height), hcode)
-            masked = Image.composite(im_frame, bg, mask)
-            masked = np.array(masked)[:, :, ::-1]  # BGR
-        writer.write(masked)
-        _, frame = vid.read()
+    if workers > 1:
+        vid.release()
+        # the background color has to be the same in all the chunks
+        color = color or choice(list(mcd.CSS4_COLORS))
+        mask_chunks(vidpath, roi_list, total, writer, workers, randseed, rand, static, color, box, noise)
+        writer.release()
+        return
+
+    masker = FrameMasker(roi_list, total, width, height, rand, static, color, box, noise)
+    stages = pipeline(read_frames(vid, frame, total), masker.apply, writer.write, depth)
     writer.release()
     vid.release()
+    for stage in stages:
+        print(stage)
+
+
+def load_jobs(jobpath: str) -> list:
+    """
+    Loads the output specifications of a job file (JSON or YAML):
+    [{"filename": <str>, "rois": [<str>, ...], "color": <str>, "rand": <bool>, "static": <bool>, "crop": <bool>}, ...]
+    either as a list or as the "outputs" field of an object.
+
+    Args:
+        jobpath (str): path to the job file
+    Returns:
+        list of output specifications
+    """
+    with open(jobpath) as file:
+        if jobpath.lower().endswith(('.yaml', '.yml')):
+            import yaml  # optional dependency, required only by YAML job files
+            jobs = yaml.safe_load(file)
+        else:
+            jobs = json.load(file)
+    outputs = jobs['outputs'] if isinstance(jobs, dict) else jobs
+    for spec in outputs:
+        if not spec.get('filename') or not spec.get('rois'):
+            raise ValueError('Each output of the job file requires "filename" and "rois": {}'.format(spec))
+    return outputs
+
+
+def multi_processing(vidpath: str, outputs: list, randseed: int = None, depth: int = 8,
+                     pool_size: int = 16, noise_pool: str = None):
+    """
+    Decodes the video once and writes several masked variants of it.
+
+    Args:
+        vidpath (str): path to video data with filename
+        outputs (list): output specifications, see load_jobs
+        randseed (int): seed of the random backgrounds, taken from the current time if omitted
+        depth (int): maximal number of frames waiting between the decoding, masking and encoding threads
+        pool_size (int): number of pre-rendered textures of the dynamic random background, 0 to generate it per frame
+        noise_pool (str): .npy file to load the textures from or to save them to
+    """
+    vid = cv2.VideoCapture(vidpath)
+    total = int(vid.get(cv2.CAP_PROP_FRAME_COUNT))  # number of frames in a video
+    _, frame = vid.read()
+    height, width = frame.shape[:2]
+    print(width, height)
+    if randseed is None:
+        now = datetime.now()
+        randseed = now.hour+now.minute+now.second
+    seed(randseed)
+    np.random.seed(randseed)
+
+    maskers, writers = [], []
+    noises = {}  # outputs of the same size share the noise textures
+    for spec in outputs:
+        roi_list = load_rois(spec['rois'], total)
+        box = None
+        if spec.get('crop'):
+            box = crop_box(roi_list, width, height)
+            save_crop(spec['filename'], box, width, height)
+        size = box[2:] if box else (width, height)
+        rand, static = spec.get('rand', False), spec.get('static', True)
+        if rand and not static and pool_size and size not in noises:
+            noises[size] = NoisePool(*size, pool_size, randseed, noise_pool)
+        masker = FrameMasker(roi_list, total, width, height, rand, static, spec.get('color'), box, noises.get(size))
+        maskers.append(masker)
+        writer = cv2.VideoWriter(spec['filename'], cv2.VideoWriter_fourcc(*'mp4v'),
+                                 vid.get(cv2.CAP_PROP_FPS), (masker.width, masker.height))
+        if not writer.isOpened():
+            raise IOError('cannot open the writer of ' + spec['filename'])
+        writers.append(writer)
+
+    def process(i, frame):
+        # unmasked frames are shared by the outputs, masked ones are composited on copies
+        return [masker.apply(i, frame, copy=True) for masker in maskers]
+
+    def write(frames):
+        for writer, frame in zip(writers, frames):
+            writer.write(frame)
+
+    stages = pipeline(read_frames(vid, frame, total), process, write, depth)
+    for writer in writers:
+        writer.release()
+    vid.release()
+    for stage in stages:
+        print(stage)
 
 
 if __name__ == '__main__':
@@ -124,13 +692,26 @@ if __name__ == '__main__':
                             conflict_handler='resolve')
     parser.add_argument('-v', '--vidpath', type=str, help='path to video', required=True)
 
-    parser.add_argument('-r', '--rois', type=str, default=[], action='append', required=True,
+    parser.add_argument('-r', '--rois', type=str, default=[], action='append',
                         help='LEFT,TOP,WIDTH,HEIGHT[;SHAPE=rect][^FRAME_START=1][!FRAME_FINISH=LAST_FRAME]]')
     parser.add_argument('-f', '--filename', type=str, help='name for a processed video')
 
     group = parser.add_mutually_exclusive_group()
     group.add_argument('-c', '--color', type=str, help='color written as a word like pink, aqua, etc.')
     group.add_argument('-rand', action="store_true", help='True if background needs to be randomly colored')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of processes masking the chunks of the video')
+    parser.add_argument('--seed', dest='randseed', type=int, help='seed of the random background')
+    parser.add_argument('-q', '--queue-depth', dest='depth', type=int, default=8,
+                        help='maximal number of frames queued between the decoding, masking and encoding threads')
+    parser.add_argument('--pool-size', type=int, default=16,
+                        help='number of pre-rendered noise textures cycled as the changing random background, '
+                             '0 to generate the noise per frame')
+    parser.add_argument('--noise-pool', type=str, help='.npy file to load the noise textures from or to save them to')
+    parser.add_argument('--crop', action="store_true",
+                        help='write only the bounding box of the ROIs and save its offset to <FILENAME>_crop.json')
+    parser.add_argument('-j', '--job-file', type=str,
+                        help='JSON or YAML file with several outputs to write in one decoding pass instead of -r and -f')
     opt = parser.parse_args()
     # "-v imgs/mixkit-leaves-wet.mp4 -r 500,300,800,600;ellipse^40 -rand -f imgs/mixkit-leaves-wet-with-roi.mp4".split())
     #1920x1061
@@ -139,4 +720,11 @@ if __name__ == '__main__':
     #from 84 to 283
     # [(737, 378, 125, 159)]
 
-    roi_processing(**vars(opt))
+    jobfile = opt.job_file
+    del opt.job_file
+    if jobfile:
+        multi_processing(opt.vidpath, load_jobs(jobfile), opt.randseed, opt.depth, opt.pool_size, opt.noise_pool)
+    elif not opt.rois:
+        parser.error('the following arguments are required: -r/--rois or -j/--job-file')
+    else:
+        roi_processing(**vars(opt))
@@ -6,49 +6,136 @@
 :Authors: (c) Valentyna Pryhodiuk <vpryhodiuk@lumais.com>
 :Date: 2021-11-04
 """
+import csv
+import json
+import os
+import shutil
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
-from json import load
-from typing import Dict, Any
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import repeat
+from typing import Dict, Any, Iterator
 from lbxTorch import count_objects, strparse
+from lbxStore import LbxStore, build_columns, is_store, load_annotations, clear_cache
+from videoIndex import VideoSeeker
 from collections import namedtuple
 
 import cv2
 import numpy as np
 
+# fields of the records of the diff report
+REPORT_FIELDS = ('file', 'frame', 'featureId', 'class', 'kind', 'attribute', 'delta', 'keyframe')
+# maximal number of frames decoded without rendering instead of seeking in the changes-only mode
+SEEK_GAP = 100
+# BGR colors of the bboxes of the reviewers if several reviewed files are compared
+REVIEWER_COLORS = ((0, 0, 255), (0, 255, 0), (255, 0, 0), (0, 255, 255), (255, 0, 255), (255, 255, 0),
+                   (0, 128, 255), (255, 128, 0))
+
+
+@lru_cache(maxsize=None)
+def hex2bgr(hcode: str) -> tuple:
+    """
+    Parses the hex color of the export once per color.
+    """
+    h = hcode.lstrip('#')
+    return tuple(int(h[i:i + 2], 16) for i in (4, 2, 0))  # BGR
+
+
+@lru_cache(maxsize=None)
+def disk(radius: int) -> np.ndarray:
+    """
+    Offsets (dy, dx) of the pixels of the filled circle drawn by cv2.circle around the origin.
+    """
+    patch = np.zeros((2 * radius + 3, 2 * radius + 3), dtype=np.uint8)
+    cv2.circle(patch, (radius + 1, radius + 1), radius, 1, -1)
+    return np.argwhere(patch) - (radius + 1)
+
+
+def dash_points(pt1: np.ndarray, pt2: np.ndarray, gap: int = 20) -> tuple:
+    """
+    Places the points every gap pixels along all the segments at once.
+
+    Args:
+        pt1, pt2 (np.ndarray): N x 2 beginnings and ends of the segments
+        gap (int): distance between the points
+    Returns:
+        points (np.ndarray) - M x 2 integer coordinates ordered by the segments,
+        local (np.ndarray) - index of each point in its segment
+    """
+    pt1, pt2 = np.asarray(pt1, dtype=np.float64).reshape(-1, 2), np.asarray(pt2, dtype=np.float64).reshape(-1, 2)
+    dist = np.hypot(*(pt1 - pt2).T)
+    num = np.ceil(dist / gap).astype(np.int64)
+    edge = np.repeat(np.arange(len(dist)), num)
+    local = np.arange(num.sum()) - np.repeat(np.cumsum(num) - num, num)
+    r = (local * gap / dist[edge])[:, None]
+    return np.trunc(pt1[edge] * (1 - r) + pt2[edge] * r + .5).astype(np.int32), local
+
+
+class Overlay:
+    """
+    Collects the rectangles, lines and labels of a frame and draws them in a few batched calls:
+    one cv2.polylines per style, color and thickness for the solid and dashed primitives, the dots of the dotted
+    ones are stamped into the image by numpy indexing.
+    """
+
+    def __init__(self):
+        self.shapes = {}  # (style, closed, color, thickness): list of the polylines
+        self.labels = []
+
+    def poly(self, pts: list, color: tuple, thickness: int = 2, style: str = '', closed: bool = True):
+        self.shapes.setdefault((style, closed, tuple(color), thickness), []).append(list(pts))
+
+    def rect(self, pt1: tuple, pt2: tuple, color: tuple, thickness: int = 2, style: str = ''):
+        self.poly([pt1, (pt2[0], pt1[1]), pt2, (pt1[0], pt2[1])], color, thickness, style)
+
+    def line(self, pt1: tuple, pt2: tuple, color: tuple, thickness: int = 2, style: str = ''):
+        self.poly([pt1, pt2], color, thickness, style, closed=False)
+
+    def text(self, text: str, org: tuple, color: tuple, scale: float = 0.8, thickness: int = 1):
+        self.labels.append((text, org, tuple(color), scale, thickness))
+
+    def draw(self, img: np.ndarray) -> np.ndarray:
+        for (style, closed, color, thickness), polys in self.shapes.items():
+            if not style:
+                cv2.polylines(img, [np.array(poly, dtype=np.int32) for poly in polys], closed, color, thickness)
+                continue
+            # the dashes and dots of all the edges are placed at once
+            pt1 = np.array([pt for poly in polys for pt in (poly if closed else poly[:-1])])
+            pt2 = np.array([pt for poly in polys for pt in (poly[1:] + poly[:1] if closed else poly[1:])])
+            pts, local = dash_points(pt1, pt2)
+            if style == 'dotted':
+                stamp(img, pts, color, thickness)
+            else:
+                # a dash joins each odd point with the previous one of the same edge
+                odd = np.flatnonzero(local % 2 == 1)
+                cv2.polylines(img, list(np.stack([pts[odd - 1], pts[odd]], axis=1)), False, color, thickness)
+        for text, org, color, scale, thickness in self.labels:
+            cv2.putText(img, text, org, cv2.FONT_HERSHEY_SIMPLEX, scale, color, thickness)
+        self.shapes, self.labels = {}, []
+        return img
+
+
+def stamp(img: np.ndarray, pts: np.ndarray, color: tuple, radius: int):
+    """
+    Draws the filled circles of the radius around all the points like cv2.circle does.
+    """
+    offsets = disk(radius)
+    ys = (pts[:, None, 1] + offsets[None, :, 0]).ravel()
+    xs = (pts[:, None, 0] + offsets[None, :, 1]).ravel()
+    inside = (ys >= 0) & (ys < img.shape[0]) & (xs >= 0) & (xs < img.shape[1])
+    img[ys[inside], xs[inside]] = color[:img.shape[2]] if img.ndim == 3 else color[0]
+
 
 def dashline(img, pt1, pt2, color, thickness=1, style='dotted', gap=20):
-    dist = ((pt1[0] - pt2[0]) ** 2 + (pt1[1] - pt2[1]) ** 2) ** .5
-    pts = []
-    for i in np.arange(0, dist, gap):
-        r = i / dist
-        x = int((pt1[0] * (1 - r) + pt2[0] * r) + .5)
-        y = int((pt1[1] * (1 - r) + pt2[1] * r) + .5)
-        p = (x, y)
-        pts.append(p)
-
-    if style == 'dotted':
-        for p in pts:
-            cv2.circle(img, p, thickness, color, -1)
-    else:
-        # s = pts[0]
-        e = pts[0]
-        i = 0
-        for p in pts:
-            s = e
-            e = p
-            if i % 2 == 1:
-                cv2.line(img, s, e, color, thickness)
-            i += 1
+    overlay = Overlay()
+    overlay.line(pt1, pt2, color, thickness, style)
+    overlay.draw(img)
 
 
 def dashpoly(img, pts, color, thickness=1, style='dotted', ):
-    # s = pts[0]
-    e = pts[0]
-    pts.append(pts.pop(0))
-    for p in pts:
-        s = e
-        e = p
-        dashline(img, s, e, color, thickness, style)
+    overlay = Overlay()
+    overlay.poly(pts, color, thickness, style)
+    overlay.draw(img)
 
 
 def dashrect(img: np.ndarray, pt1: tuple, pt2: tuple,
@@ -63,11 +150,13 @@ def dashrect(img: np.ndarray, pt1: tuple, pt2: tuple,
         color (tuple): BGR color with values from 0 to 255
         style (str): dotted or else
     """
-    pts = [pt1, (pt2[0], pt1[1]), pt2, (pt1[0], pt2[1])]
-    dashpoly(img, pts, color, thickness, style)
+    overlay = Overlay()
+    overlay.rect(pt1, pt2, color, thickness, style)
+    overlay.draw(img)
 
 
-def visualize_bbox(image: np.ndarray, tool: Dict[str, Any], thickness: int = 2, style: str = '') -> np.ndarray:
+def visualize_bbox(image: np.ndarray, tool: Dict[str, Any], thickness: int = 2, style: str = '',
+                   color: tuple = None, overlay: Overlay = None) -> np.ndarray:
     """
     Draws a bounding box on an image
 
@@ -75,15 +164,19 @@ def visualize_bbox(image: np.ndarray, tool: Dict[str, Any], thickness: int = 2,
         image (np.ndarray): image to draw a bounding box onto
         tool (Dict[str,any]): Dict response from the export
         style (str): False if rectangle without dashes have to be drawn
+        color (tuple): BGR color instead of the color of the object
+        overlay (Overlay): the bbox is added to the overlay drawn later instead of the image
     Returns:
         image with a bounding box drawn on it.
     """
     start = (int(tool['bbox']["left"]), int(tool['bbox']["top"]))
     end = (int(tool['bbox']["left"] + tool['bbox']["width"]),
            int(tool['bbox']["top"] + tool['bbox']["height"]))
-    h = tool['color'].lstrip('#')
-    color = tuple(int(h[i:i + 2], 16) for i in (4, 2, 0))  # BGR
-    if style:
+    if color is None:
+        color = hex2bgr(tool['color'])
+    if overlay is not None:
+        overlay.rect(start, end, color, thickness, style)
+    elif style:
         dashrect(image, start, end, color, thickness, style)
     else:
         cv2.rectangle(image, start, end, color, thickness)
@@ -130,101 +223,413 @@ def get_attr(obj: Dict) -> Dict:
     return attrs
 
 
+def as_store(annotations) -> LbxStore:
+    """
+    Returns the columnar view of the annotations, the bboxes of the json files are kept as float64.
+    """
+    if isinstance(annotations, LbxStore):
+        return annotations
+    annotations = list(annotations)
+    return LbxStore(*build_columns(annotations, exact=True), source=annotations)
+
+
+def count_bits(masks: np.ndarray, nbits: int) -> np.ndarray:
+    counts = np.zeros(len(masks), dtype=np.int64)
+    for bit in range(nbits):
+        counts += (masks >> np.uint64(bit)) & np.uint64(1) != 0
+    return counts
+
+
+def join_objects(orig: LbxStore, rev: LbxStore, epsilon: float = 0) -> Dict[str, np.ndarray]:
+    """
+    Joins the objects of the frames with the same position in both files on featureId
+    and compares the bboxes and attributes of all joined pairs at once.
+
+    Args:
+        orig (LbxStore): annotations before corrections
+        rev (LbxStore): annotations after corrections
+        epsilon (float): the maximum permissible error of the bbox dimension, the bboxes are compared as float32
+            if one of the stores keeps them so
+    Returns:
+        arrays of the pairs ordered by the reviewed objects:
+        {"frame": frame position, "rev", "orig": indices of the objects (orig is -1 for the new reviewed objects),
+         "changed": True if the object is new or its bbox is changed by more than epsilon,
+         "keychanged": True if the change is made by the reviewer,
+         "attrs": number of the attributes added by the review, "keyattrs": the number of them made by the reviewer,
+         "added", "keyadded": bitmasks of these attributes (see LbxStore.attributes of rev),
+         "delta": maximal difference of the bbox dimensions, nan for the new objects}
+    """
+    total = min(len(orig), len(rev))
+    ocount, rcount = int(orig.offsets[total]), int(rev.offsets[total])
+    oframe = np.repeat(np.arange(total), np.diff(orig.offsets[:total + 1]))
+    rframe = np.repeat(np.arange(total), np.diff(rev.offsets[:total + 1]))
+
+    # the keys (frame, featureId) of the reviewed objects are expressed in the featureIds of the original ones
+    features = {featureId: i for i, featureId in enumerate(orig.features)}
+    rfeature = np.array([features.get(featureId, -1) for featureId in rev.features] + [-1],
+                        dtype=np.int64)[rev.feature[:rcount]]
+    okeys = oframe * len(orig.features) + orig.feature[:ocount]
+    rkeys = np.where(rfeature >= 0, rframe * len(orig.features) + rfeature, -1)
+
+    # hash join of the sorted original keys, the objects with the same featureId keep their order
+    order = np.argsort(okeys, kind='stable')
+    first = np.searchsorted(okeys[order], rkeys, 'left')
+    matches = np.searchsorted(okeys[order], rkeys, 'right') - first
+    reps = np.maximum(matches, 1)
+    rind = np.repeat(np.arange(rcount), reps)
+    matched = np.repeat(matches, reps) > 0
+    shift = np.arange(len(rind)) - np.repeat(np.cumsum(reps) - reps, reps)
+    oind = np.full(len(rind), -1)
+    oind[matched] = order[np.repeat(first, reps)[matched] + shift[matched]]
+    rpair, opair = rind[matched], oind[matched]
+
+    # the bboxes are compared at the precision of the less precise store, so the float32 rounding of one of them
+    # is not taken for a move
+    dtype = np.float32 if np.float32 in (orig.bbox.dtype, rev.bbox.dtype) else np.float64
+    delta = np.full(len(rind), np.nan)
+    delta[matched] = np.max(np.abs(rev.bbox[rpair].astype(dtype) - orig.bbox[opair].astype(dtype)),
+                            axis=1, initial=0)
+    changed = ~matched | (delta > epsilon)
+    keychanged = changed & (~matched | rev.keyframe[rind])
+
+    # attributes of the original objects are expressed in the bits of the reviewed ones
+    oattrs = orig.attrs[opair]
+    translated = np.zeros(len(opair), dtype=np.uint64)
+    for bit, value in enumerate(orig.attributes):
+        if value in rev.attributes:
+            translated |= ((oattrs >> np.uint64(bit)) & np.uint64(1)) << np.uint64(rev.attributes.index(value))
+    added = np.zeros(len(rind), dtype=np.uint64)
+    added[matched] = rev.attrs[rpair] & ~translated
+    keyadded = added & rev.attr_keyframes[rind]
+    return {'frame': rframe[rind], 'rev': rind, 'orig': oind, 'changed': changed, 'keychanged': keychanged,
+            'attrs': count_bits(added, len(rev.attributes)), 'keyattrs': count_bits(keyadded, len(rev.attributes)),
+            'added': added, 'keyadded': keyadded, 'delta': delta}
+
+
+def frame_ranges(keyframes: str, total: int, length: int) -> list:
+    """
+    Args:
+        keyframes (str): intervals of frames <n1>-<n2>,<n3>-<n4>,<n5>...
+        total (int): number of frames of the original annotations
+        length (int): number of frames present in both files
+    Returns:
+        list of the intervals (beginning, ending) of the frame numbers
+    """
+    ranges = []
+    for [beginning, ending] in strparse(keyframes):
+        ending = total if ending == '$' else int(ending)
+        if ending > length:
+            raise IndexError("Invalid frame's range.")
+        ranges.append((int(beginning), ending))
+    return ranges
+
+
+def iter_changes(orig: LbxStore, rev: LbxStore, pairs: Dict[str, np.ndarray], ranges: list) -> Iterator[Dict]:
+    """
+    Yields the records of the changes of the frames of the intervals (see frame_ranges)
+    {"frame": <frameNumber>, "featureId", "class": <title of the reviewed object>,
+     "kind": "moved", "new" or "attr-added", "attribute": <value of the added attribute>,
+     "delta": <maximal difference of the bbox dimensions>, "keyframe": True if the change is made by the reviewer}
+    """
+    bounds = np.searchsorted(pairs['frame'], np.arange(min(len(orig), len(rev)) + 1))
+    for beginning, ending in ranges:
+        if beginning > ending:
+            continue
+        first, last = bounds[beginning - 1], bounds[ending]
+        for pair in first + np.flatnonzero(pairs['changed'][first:last] | (pairs['added'][first:last] != 0)):
+            obj = pairs['rev'][pair]
+            record = {'frame': int(rev.frames[pairs['frame'][pair]]), 'featureId': rev.features[rev.feature[obj]],
+                      'class': rev.classes[rev.cls[obj]]}
+            if pairs['changed'][pair]:
+                new = pairs['orig'][pair] < 0
+                yield dict(record, kind='new' if new else 'moved', attribute=None,
+                           delta=None if new else float(pairs['delta'][pair]),
+                           keyframe=bool(pairs['keychanged'][pair]))
+            added, keyadded = int(pairs['added'][pair]), int(pairs['keyadded'][pair])
+            for bit, value in enumerate(rev.attributes):
+                if added >> bit & 1:
+                    yield dict(record, kind='attr-added', attribute=value, delta=None,
+                               keyframe=bool(keyadded >> bit & 1))
+
+
+def write_report(annotated: str, reviewed: str, report: str, keyframes: str = '1-$', epsilon: float = 0,
+                 cache: bool = True, name: str = None, header: bool = True) -> tuple:
+    """
+    Streams the records of the changes (see iter_changes) to the .csv or .jsonl (otherwise) report
+    without touching the video.
+
+    Args:
+        annotated (str): path to annotation file (or store) before corrections
+        reviewed (str): path to annotation file (or store) after corrections
+        report (str): path to the report
+        keyframes (str): intervals of frames that should be taken into account
+        epsilon (float): the maximum permissible error of the bbox dimension
+        cache (bool): False if the json files should be parsed bypassing the cache of the parsed annotations
+        name (str): value of the "file" field of the records, the name of the annotated file by default
+        header (bool): False if the header of the csv report should be omitted
+    Return:
+        numclschanges, numattrchanges, numcorcls, numcorattr (see main) computed from the records
+    """
+    orFile = as_store(load_annotations(annotated, cache))
+    revFile = as_store(load_annotations(reviewed, cache))
+    ranges = frame_ranges(keyframes, len(orFile), min(len(orFile), len(revFile)))
+    pairs = join_objects(orFile, revFile, epsilon)
+    name = name or os.path.basename(annotated.rstrip(os.sep))
+
+    totals = [0, 0, 0, 0]
+    with open(report, 'w', newline='') as file:
+        if report.endswith('.csv'):
+            writer = csv.DictWriter(file, REPORT_FIELDS)
+            if header:
+                writer.writeheader()
+            write = writer.writerow
+        else:
+            def write(record):
+                file.write(json.dumps(record) + '\n')
+        for record in iter_changes(orFile, revFile, pairs, ranges):
+            attr = record['kind'] == 'attr-added'
+            totals[attr] += 1
+            totals[2 + attr] += record['keyframe']
+            write(dict(file=name, **record))
+    return tuple(totals)
+
+
+def report_dirs(annotated: str, reviewed: str, report: str, keyframes: str = '1-$', epsilon: float = 0,
+                cache: bool = True, jobs: int = None) -> Dict[str, tuple]:
+    """
+    Writes the report of the pairs of the files with the same names (json files or stores) in the directories
+    by a process pool. The workers write the parts of the report, which are joined in the order of the names.
+
+    Return:
+        {<name>: <totals returned by write_report>}
+    """
+    names = sorted(name for name in os.listdir(annotated)
+                   if (name.endswith('.json') or is_store(os.path.join(annotated, name)))
+                   and os.path.exists(os.path.join(reviewed, name)))
+    parts = ['{}.{}.part'.format(report, i) for i in range(len(names))]
+    with ProcessPoolExecutor(jobs) as pool:
+        results = list(pool.map(write_report, [os.path.join(annotated, name) for name in names],
+                                [os.path.join(reviewed, name) for name in names], parts, repeat(keyframes),
+                                repeat(epsilon), repeat(cache), names, repeat(False)))
+    with open(report, 'w', newline='') as file:
+        if report.endswith('.csv'):
+            csv.DictWriter(file, REPORT_FIELDS).writeheader()
+        for part in parts:
+            with open(part, newline='') as partfile:
+                shutil.copyfileobj(partfile, file)
+            os.remove(part)
+    return dict(zip(names, results))
+
+
+def draw_changes(img: np.ndarray, orig: LbxStore, rev: LbxStore, pairs: Dict[str, np.ndarray], bounds: np.ndarray,
+                 pos: int, color: tuple = None) -> np.ndarray:
+    """
+    Draws the changed objects of the frame: the original bbox and the reviewed dotted one for the moved objects,
+    the dashed bbox for the new ones.
+
+    Args:
+        img (np.ndarray): the frame of the video
+        orig, rev (LbxStore): annotations before and after corrections
+        pairs (dict): joined objects returned by join_objects
+        bounds (np.ndarray): pairs of the frame i are bounds[i]:bounds[i + 1]
+        pos (int): position of the frame
+        color (tuple): BGR color of the reviewed bboxes instead of the color of the objects
+    Returns:
+        image with the bounding boxes drawn on it
+    """
+    rFrame, oFrame = rev.frame(pos), orig.frame(pos)
+    rstart, ostart = rev.span(pos)[0], orig.span(pos)[0]
+    overlay = Overlay()
+    for pair in range(bounds[pos], bounds[pos + 1]):
+        if not pairs['changed'][pair]:
+            continue
+        rObj = rFrame['objects'][pairs['rev'][pair] - rstart]
+        if pairs['orig'][pair] >= 0:
+            visualize_bbox(img, oFrame['objects'][pairs['orig'][pair] - ostart], overlay=overlay)
+            visualize_bbox(img, rObj, style='dotted', color=color, overlay=overlay)
+        else:
+            visualize_bbox(img, rObj, style='dashed', color=color, overlay=overlay)
+    return overlay.draw(img)
+
+
+def burn_frame_number(img: np.ndarray, frameNum: int) -> np.ndarray:
+    text = 'frame {}'.format(frameNum)
+    cv2.putText(img, text, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 0), 4, cv2.LINE_AA)
+    cv2.putText(img, text, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2, cv2.LINE_AA)
+    return img
+
+
+def burn_legend(img: np.ndarray, names: list, colors: list) -> np.ndarray:
+    """
+    Writes the names of the reviewed files in the colors of their bboxes under the frame number.
+    """
+    for i, (name, color) in enumerate(zip(names, colors)):
+        text = os.path.basename(name.rstrip(os.sep))
+        cv2.putText(img, text, (10, 60 + 25 * i), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 0), 4, cv2.LINE_AA)
+        cv2.putText(img, text, (10, 60 + 25 * i), cv2.FONT_HERSHEY_SIMPLEX, 0.7, color, 2, cv2.LINE_AA)
+    return img
+
+
+def object_agreement(orig: LbxStore, joined: list, ranges: list, length: int) -> tuple:
+    """
+    Compares the decisions of several reviewers about each original object of the frames of the intervals.
+
+    Args:
+        orig (LbxStore): annotations before corrections
+        joined (list): pairs returned by join_objects for each reviewer
+        ranges (list): intervals of the frame numbers (see frame_ranges)
+        length (int): number of frames present in all files
+    Returns:
+        status (np.ndarray) - objects x reviewers matrix, 0 if the object is kept, 1 if it is moved, 2 if removed,
+        agreement (np.ndarray) - reviewers x reviewers matrix of the shares of the objects with the same status
+    """
+    inside = np.zeros(length, dtype=bool)
+    for beginning, ending in ranges:
+        inside[beginning - 1:ending] = True
+    count = int(orig.offsets[length])
+    objects = np.flatnonzero(np.repeat(inside, np.diff(orig.offsets[:length + 1])))
+
+    status = np.full((count, len(joined)), 2, dtype=np.int8)
+    for reviewer, pairs in enumerate(joined):
+        matched = pairs['orig'] >= 0
+        status[pairs['orig'][matched], reviewer] = 0
+        moved = matched & pairs['changed']
+        status[pairs['orig'][moved], reviewer] = 1
+    status = status[objects]
+    agreement = (status[:, :, None] == status[:, None, :]).mean(axis=0) if len(status) else \
+        np.ones((len(joined), len(joined)))
+    return status, agreement
+
+
+def print_agreement(names: list, status: np.ndarray, agreement: np.ndarray):
+    print("----------Agreement-----------")
+    print("Original objects: {}".format(len(status)))
+    for i, name in enumerate(names):
+        print("{}: {}: moved {}, removed {}, agreement {}".format(
+            i + 1, name, int(np.sum(status[:, i] == 1)), int(np.sum(status[:, i] == 2)),
+            ' '.join('{:.3f}'.format(value) for value in agreement[i])))
+
+
+def decode_runs(touched: np.ndarray, ranges: list, context: int = 0, gap: int = SEEK_GAP) -> list:
+    """
+    Groups the frames with changes and their context into the runs decoded after one seek.
+
+    Args:
+        touched (np.ndarray): True for the positions of the frames with changes
+        ranges (list): intervals of the frame numbers (see frame_ranges)
+        context (int): number of frames rendered on each side of the changed frames
+        gap (int): maximal number of frames decoded without rendering between the merged runs,
+            seeking is slower for the long GOPs
+    Returns:
+        render (np.ndarray) - True for the positions of the rendered frames,
+        list of the runs (first, last) of the frame numbers
+    """
+    inside = np.zeros(len(touched), dtype=bool)
+    for beginning, ending in ranges:
+        inside[beginning - 1:ending] = True
+    changed = (touched & inside).astype(np.int64)
+    # frames within context of the changed ones
+    near = np.concatenate([[0], np.cumsum(changed)])
+    positions = np.arange(len(touched))
+    render = inside & (near[np.minimum(positions + context + 1, len(touched))] -
+                       near[np.maximum(positions - context, 0)] > 0)
+
+    runs = []
+    for pos in np.flatnonzero(render):
+        if runs and pos + 1 - runs[-1][1] <= gap + 1:
+            runs[-1][1] = int(pos) + 1
+        else:
+            runs.append([int(pos) + 1, int(pos) + 1])
+    return render, [tuple(run) for run in runs]
+
+
 def main(annotated: str, reviewed: str, video: str, scale: float = 2, vidreview: str = None, keyframes: str = '1-$',
-         epsilon: float = 0, mal: bool = False):
+         epsilon: float = 0, mal: bool = False, cache: bool = True, changes_only: bool = False, context: int = 0):
     """
     If video is given, draws annotation difference between given files.
 
     Args:
-        annotated (str): path to annotation file before corrections
-        reviewed (str): path to annotation file after corrections
+        annotated (str): path to annotation file (or store) before corrections
+        reviewed (str, list): path to annotation file (or store) after corrections or the list of such paths
+            of several reviewers, which are compared in one pass
         video (str): path to data with filename
         keyframes (str): intervals of frames that should be taken into account
+        cache (bool): False if the json files should be parsed bypassing the cache of the parsed annotations
+        changes_only (bool): True if only the frames with changes (and their context) should be written
+            to the output video with the frame numbers burned in
+        context (int): number of frames written on each side of the changed frames
     Return:
         numclschanges (int) - number of changes in total (among classes such as ant, ant-head, etc.)
         numattrchanges (int) - number of changes in total (among attributes such as blurry, side-view, etc.)
         numcorcls (int) - number of changes made by the reviewer (among classes)
         numcorattr (int) - number of changes made by the reviewer (among attributes)
+        or the list of these tuples for each reviewer if several reviewed files are given
     """
-    with open(annotated) as f1:
-        orFile = load(f1)
-        f1.close()
-    with open(reviewed) as f2:
-        revFile = load(f2)
-        f2.close()
+    several = not isinstance(reviewed, str)
+    reviewed = list(reviewed) if several else [reviewed]
+    orFile = as_store(load_annotations(annotated, cache))
+    revFiles = [as_store(load_annotations(path, cache)) for path in reviewed]
 
     totalel = count_objects(orFile, keyframes, 0)
     total = len(orFile)
     print("------------Total-------------")
     print(f"Annotated classes: {totalel[0]}\nAnnotated attributes: {totalel[1]}".format(totalel))
-    # orFile = shorten_file(orFile)
-    # revFile = shorten_file(revFile)
 
     writer = None
     if video:
-        vid = cv2.VideoCapture(video)
+        vid = VideoSeeker(video)
         if vidreview is not None:
             _, img = vid.read()
             height, width = img.shape[:2]
             writer = cv2.VideoWriter(vidreview, cv2.VideoWriter_fourcc(*'mp4v'),
                                      vid.get(cv2.CAP_PROP_FPS), (width, height))
-    # changes in total made by both AI and in hand
-    numclschanges = 0
-    numattrchanges = 0
-    # changes in made especially by the reviewer
-    numcorcls = 0
-    numcorattr = 0
-
-    framelst = strparse(keyframes)
-
-    for [beginning, ending] in framelst:
-        ending = total if ending == '$' else ending
 
-        if video:
-            vid.set(cv2.CAP_PROP_POS_FRAMES, int(beginning))
-            _, img = vid.read()
-        else:
-            img = np.zeros((1, 1), np.uint8)
-
-        for frameNum in range(int(beginning), int(ending) + 1):
-            show = False
-            rFrame = revFile[frameNum - 1]
-            oFrame = orFile[frameNum - 1]
-
-            for rObj in rFrame['objects']:
-                flag = False  # to track down if it's not a new object
-                for oObj in oFrame['objects']:
-                    if rObj['featureId'] == oObj['featureId']:
-                        mistake = [abs(rObj['bbox'][dim] - oObj['bbox'][dim]) <= epsilon for dim in rObj['bbox'].keys()]
-                        if mistake != [1] * 4:
-                            numclschanges += 1
-                            show = video
-                            img = visualize_bbox(img, oObj)
-                            img = visualize_bbox(img, rObj, style='dotted')
-                            if rObj['keyframe']:
-                                numcorcls += 1
-                        flag = True
-                        rAtr = get_attr(rObj)
-                        oAtr = get_attr(oObj)
-                        for attr, keyframe in rAtr.items():
-                            if attr not in oAtr:
-                                if keyframe:
-                                    numcorattr += 1
-                                numattrchanges += 1
-                            # elif keyframe and not oAtr[attr]:
-                            #     numcorattr += 1
-                            #     numattrchanges += 1
-                            # elif keyframe != oAtr[attr]:
-                            #     numattrchanges += 1
-
-                if not flag:
-                    numcorcls += 1
-                    numclschanges += 1
-                    show = video
-                    img = visualize_bbox(img, rObj, style='dashed')
+    # the original annotations are loaded and the video is decoded once for all reviewers
+    length = min(total, *map(len, revFiles))
+    joined = [join_objects(orFile, revFile, epsilon) for revFile in revFiles]
+    # boundaries of the changed pairs of each frame
+    bounds = [np.searchsorted(pairs['frame'], np.arange(length + 1)) for pairs in joined]
+    touched = np.zeros(length, dtype=bool)
+    for pairs in joined:
+        touched[pairs['frame'][pairs['changed'] & (pairs['frame'] < length)]] = True
+    # the boxes of the reviewers are drawn in their colors if there are several of them
+    colors = [REVIEWER_COLORS[i % len(REVIEWER_COLORS)] for i in range(len(reviewed))] if several else [None]
+
+    def draw(img, pos):
+        for revFile, pairs, pairbounds, color in zip(revFiles, joined, bounds, colors):
+            img = draw_changes(img, orFile, revFile, pairs, pairbounds, pos, color)
+        return burn_legend(img, reviewed, colors) if several else img
+
+    ranges = frame_ranges(keyframes, total, length)
+    results = []
+    for pairs in joined:
+        # prefix sums of the per-frame counters: changes in total made by both AI and in hand
+        # and changes made especially by the reviewer
+        sums = [np.concatenate([[0], np.cumsum(np.bincount(pairs['frame'], weights=pairs[name],
+                                                           minlength=length)[:length])])
+                for name in ('changed', 'attrs', 'keychanged', 'keyattrs')]
+        results.append(tuple(sum(int(counter[ending] - counter[beginning - 1])
+                                 for beginning, ending in ranges if beginning <= ending) for counter in sums))
+    if several:
+        print_agreement(reviewed, *object_agreement(orFile, joined, ranges, length))
+
+    for beginning, ending in ranges:
+        if not video or changes_only and writer is not None:
+            break
+        for frameNum in range(beginning, ending + 1):
+            if not video:
+                break
+            # only the frames with changes are decoded and drawn unless the output video is written
+            vid.grab(frameNum)
+            show = touched[frameNum - 1]
+            if not show and writer is None:
+                continue
+            _, img = vid.retrieve()
+            if show:
+                img = draw(img, frameNum - 1)
             if writer is not None:
                 writer.write(img)
-            elif show:
+            else:
                 wTitle = 'frameNumber ' + str(frameNum)
                 cv2.namedWindow(wTitle, cv2.WINDOW_NORMAL)
                 h, w = img.shape[:2]
@@ -236,15 +641,22 @@ def main(annotated: str, reviewed: str, video: str, scale: float = 2, vidreview:
                     if key == 27:
                         video = ''
                 cv2.destroyAllWindows()
-
-            if video:
-                _, img = vid.read()
-                # frame = frame[:, :, ::-1]
+    if changes_only and writer is not None:
+        render, runs = decode_runs(touched, ranges, context)
+        for first, last in runs:
+            for frameNum in range(first, last + 1):
+                vid.grab(frameNum)
+                if not render[frameNum - 1]:
+                    continue
+                _, img = vid.retrieve()
+                if touched[frameNum - 1]:
+                    img = draw(img, frameNum - 1)
+                writer.write(burn_frame_number(img, frameNum))
     if writer is not None:
         writer.release()
     if video:
         vid.release()
-    return numclschanges, numattrchanges, numcorcls, numcorattr
+    return results if several else results[0]
 
 
 if __name__ == '__main__':
@@ -252,7 +664,9 @@ if __name__ == '__main__':
                             formatter_class=ArgumentDefaultsHelpFormatter,
                             conflict_handler='resolve')
     parser.add_argument('-a', '--annotated', type=str, help='Path to the JSON file of original annotations', required=True)
-    parser.add_argument('-r', '--reviewed', type=str, help='Path to the JSON file of reviewed annotations', required=True)
+    parser.add_argument('-r', '--reviewed', type=str, nargs='+', required=True,
+                        help='Path to the JSON file of reviewed annotations, several files of different reviewers '
+                             'are compared with the original one in a single pass')
 
     parser.add_argument('-v', '--video', type=str, default='', help='Path to the original video')
     parser.add_argument('-o', '--output-video', dest='vidreview', type=str,
@@ -260,14 +674,46 @@ if __name__ == '__main__':
     parser.add_argument('-k', '--keyframes', type=str, default='1-$', help='Target intervals of frames if necessary')
     parser.add_argument('-e', '--epsilon', type=float, default=0,
                         help='The maximum permissible error of the bbox dimension')
+    parser.add_argument('--changes-only', action='store_true',
+                        help='Write only the frames with changes to the output video with the frame numbers burned in')
+    parser.add_argument('--context', type=int, default=0,
+                        help='Number of frames written on each side of the changed frames with --changes-only')
+    parser.add_argument('--report', type=str,
+                        help='Write the changes to the .jsonl or .csv report without the video, -a and -r can be '
+                             'the directories of the files with the same names')
+    parser.add_argument('--jobs', type=int, default=None,
+                        help='Number of processes writing the report of the directories, the number of CPUs by default')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='parse the json files bypassing the cache of the parsed annotations')
+    parser.add_argument('--clear-cache', action='store_true', help='clear the cache of the parsed annotations')
     opt = parser.parse_args()
     # '-a original_3-38_3-52.json -r review_3-38_3-52.json -k 1-35 -e 2 -v Cflo_troph_count_3-38_3-52.mp4'.split())
     # '-a ./imgs/leaf_original.json -r ./imgs/leaf_review.json -v ./imgs/mixkit-leaves-wet.mp4'.split())
-    res = main(**vars(opt))
-
-    print(
-        (f"Corrected classes: {res[0]}\n"
-         f"Corrected attributes: {res[1]}\n"
-         f"Corrected classes in keyframes: {res[2]}\n"
-         f"Corrected attributes in keyframes: {res[3]}").format(res))
+    if opt.clear_cache:
+        clear_cache()
+    del opt.clear_cache
+    report, jobs = opt.report, opt.jobs
+    del opt.report, opt.jobs
+    if len(opt.reviewed) == 1:
+        opt.reviewed = opt.reviewed[0]
+    elif report:
+        parser.error('--report compares the original annotations with a single reviewed file')
+    if not report:
+        res = main(**vars(opt))
+    elif os.path.isdir(opt.annotated) and not is_store(opt.annotated):
+        results = report_dirs(opt.annotated, opt.reviewed, report, opt.keyframes, opt.epsilon, opt.cache, jobs)
+        for name, totals in results.items():
+            print("{}: {} {} {} {}".format(name, *totals))
+        res = tuple(sum(totals[i] for totals in results.values()) for i in range(4))
+    else:
+        res = write_report(opt.annotated, opt.reviewed, report, opt.keyframes, opt.epsilon, opt.cache)
+
+    for name, totals in (zip(opt.reviewed, res) if isinstance(res, list) else [(None, res)]):
+        if name:
+            print("------{}------".format(name))
+        print(
+            (f"Corrected classes: {totals[0]}\n"
+             f"Corrected attributes: {totals[1]}\n"
+             f"Corrected classes in keyframes: {totals[2]}\n"
+             f"Corrected attributes in keyframes: {totals[3]}").format(totals))
 
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+:Description: Writers of the YOLO label files either as separate txt files or packed into sharded tar archives,
+and the reader to stream or expand the archives on the training side.
+
+:Authors: (c) Valentyna Pryhodiuk <vpryhodiuk@lumais.com>
+:Date: 2026-10-17
+"""
+import hashlib
+import io
+import json
+import os
+import re
+import tarfile
+import time
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from glob import glob
+from typing import Callable, Iterator, List, Tuple
+
+# size of the write buffer of the archives
+BUFFER_SIZE = 1 << 20
+
+
+class LabelDir:
+    """
+    Writes each label file separately into the output directory.
+    If the prefix is given, the content hashes of the written files are kept in <prefix>.manifest.json,
+    so the next run rewrites only the changed files and deletes the files of its scope it has not produced.
+    The files out of the scope (e.g. the frames out of the requested range) are kept with their hashes.
+
+    Args:
+        outdir (str): output directory
+        prefix (str): name of the manifest
+        scope (callable): True for the names of the files this run is responsible for, all of them by default
+    """
+
+    def __init__(self, outdir: str, prefix: str = None, scope: Callable[[str], bool] = None):
+        self.outdir = outdir
+        self.scope = scope
+        self.manifest = os.path.join(outdir, prefix + '.manifest.json') if prefix else None
+        self.hashes = {}
+        self.changes = {'added': 0, 'changed': 0, 'removed': 0}
+        self.old = {}
+        os.makedirs(outdir, exist_ok=True)
+        if self.manifest and os.path.isfile(self.manifest):
+            with open(self.manifest, 'r') as file:
+                self.old = json.load(file)
+
+    def write(self, name: str, text: str):
+        path = os.path.join(self.outdir, name)
+        if self.manifest:
+            digest = hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+            self.hashes[name] = digest
+            old = self.old.get(name)
+            if old == digest and os.path.isfile(path):
+                return
+            self.changes['changed' if old else 'added'] += 1
+        with open(path, 'w') as file:
+            file.write(text)
+
+    def close(self):
+        if not self.manifest:
+            return
+        for name in self.old.keys() - self.hashes.keys():
+            if self.scope is not None and not self.scope(name):
+                self.hashes[name] = self.old[name]
+                continue
+            path = os.path.join(self.outdir, name)
+            if os.path.isfile(path):
+                os.remove(path)
+            self.changes['removed'] += 1
+        # the manifest is replaced atomically, an interrupted run is repeated by the next one
+        with open(self.manifest + '.part', 'w') as file:
+            json.dump(self.hashes, file)
+        os.replace(self.manifest + '.part', self.manifest)
+
+
+class ShardWriter:
+    """
+    Packs the label files into tar archives <prefix>-<shard number>.tar of shard_size files each.
+    Writes are buffered, each archive is synced to the disk once and renamed from .tar.part when complete.
+    The archives of the prefix left by a previous run beyond the last written one are removed on closing.
+    """
+
+    def __init__(self, outdir: str, prefix: str, shard_size: int = 10000):
+        self.outdir = outdir
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.shard = -1
+        self.count = 0
+        self.file = None
+        self.tar = None
+        self.mtime = int(time.time())
+        os.makedirs(outdir, exist_ok=True)
+
+    def path(self, shard: int) -> str:
+        return os.path.join(self.outdir, '{}-{:05d}.tar'.format(self.prefix, shard))
+
+    def _open(self):
+        self.shard += 1
+        self.count = 0
+        self.file = open(self.path(self.shard) + '.part', 'wb', buffering=BUFFER_SIZE)
+        self.tar = tarfile.open(fileobj=self.file, mode='w', format=tarfile.USTAR_FORMAT)
+
+    def _flush(self):
+        if self.tar is None:
+            return
+        self.tar.close()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.path(self.shard) + '.part', self.path(self.shard))
+        self.tar = self.file = None
+
+    def write(self, name: str, text: str):
+        if self.tar is None:
+            self._open()
+        data = text.encode()
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = self.mtime
+        self.tar.addfile(info, io.BytesIO(data))
+        self.count += 1
+        if self.count >= self.shard_size:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        # the stale archives would be mixed into the training by list_shards
+        pattern = re.compile(re.escape(self.prefix) + r'-(\d{5,})\.tar(\.part)?$')
+        for name in os.listdir(self.outdir):
+            match = pattern.match(name)
+            if match and (match.group(2) or int(match.group(1)) > self.shard):
+                os.remove(os.path.join(self.outdir, name))
+
+
+def list_shards(paths: List[str]) -> List[str]:
+    """
+    Args:
+        paths (list): tar archives or directories containing them
+    Returns:
+        sorted list of the archives
+    """
+    shards = []
+    for path in paths:
+        shards += sorted(glob(os.path.join(path, '*.tar'))) if os.path.isdir(path) else [path]
+    return shards
+
+
+def iter_labels(paths: List[str]) -> Iterator[Tuple[str, str]]:
+    """
+    Streams the label files from the archives without extracting them.
+
+    Args:
+        paths (list): tar archives or directories containing them
+    Returns:
+        iterator over (name of the label file, its text)
+    """
+    for shard in list_shards(paths):
+        # the archives are read sequentially as streams
+        with tarfile.open(shard, mode='r|') as tar:
+            for info in tar:
+                if info.isfile():
+                    yield info.name, tar.extractfile(info).read().decode()
+
+
+def expand(paths: List[str], outdir: str) -> int:
+    """
+    Extracts the label files from the archives into the directory.
+
+    Args:
+        paths (list): tar archives or directories containing them
+        outdir (str): output directory for the label files
+    Returns:
+        number of the extracted files
+    """
+    writer = LabelDir(outdir)
+    num = 0
+    for name, text in iter_labels(paths):
+        writer.write(os.path.basename(name), text)
+        num += 1
+    return num
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Document Taxonomy Builder.',
+                            formatter_class=ArgumentDefaultsHelpFormatter,
+                            conflict_handler='resolve')
+    parser.add_argument('-i', '--input', nargs='+', help='Label archives or directories with them', required=True)
+    parser.add_argument('-o', '--outp-dir', type=str,
+                        default=os.path.join(os.getcwd(), 'labels'),
+                        help='Output directory for the label files')
+    args = parser.parse_args()
+
+    print('extracted {} label files to {}'.format(expand(args.input, args.outp_dir), args.outp_dir))